@@ -3,11 +3,14 @@ from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr
-from sqlalchemy.orm import Session
-from backend import crud, models, schemas
-from backend.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from backend import crud, models, passwords, principals, schemas
+from backend.permissions import has_permission, registry as permission_registry
+from backend import database
+from backend.database import get_async_db
+from backend.ratelimit import LoginAttempt, throttle_login
+from backend.replicas import get_read_db
 import secrets
 import string
 
@@ -16,9 +19,6 @@ SECRET_KEY = "YOUR_SECRET_KEY_HERE"  # Replace with a proper secret key in produ
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
@@ -50,11 +50,8 @@ class SimpleRegisterRequest(BaseModel):
     national_id: str
 
 # Helper functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return passwords.hash_password_sync(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -70,15 +67,32 @@ def generate_reset_token(length=32):
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = crud.get_user_by_email(db, email=email)
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await crud.get_user_by_email_async(db, email=email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await passwords.verify_and_update(password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash:
+        await store_rehashed_password(user, new_hash)
     return user
 
-def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+async def store_rehashed_password(user: models.User, new_hash: str):
+    """Replace a hash made under an older hashing policy (see backend/passwords.py).
+
+    `db` in the login route may be a read replica, so this writes through its own
+    primary session. A failure only leaves the old hash in place - the login goes on.
+    """
+    try:
+        async with database.AsyncSessionLocal() as db:
+            stored = await crud.update_password_hash_async(db, user.id, user.hashed_password, new_hash)
+    except Exception as e:
+        print(f"❌ Storing the rehashed password of user {user.id} failed: {str(e)}")
+        stored = False
+    passwords.record_rehash(stored)
+
+def decode_access_token(token: str) -> dict:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -86,22 +100,71 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_email(db, email=token_data.email)
+    if payload.get("sub") is None:
+        raise credentials_exception
+    return payload
+
+async def get_token_claims(token: str = Depends(oauth2_scheme)) -> dict:
+    # A dependency, so a request that needs the claims in several places decodes the token once
+    return decode_access_token(token)
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme), payload: dict = Depends(get_token_claims)
+) -> schemas.User:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    token_data = TokenData(email=payload["sub"])
+    # The signature and expiry are checked above on every request; only the user lookup is cached
+    user = principals.get_principal(token)
     if user is None:
+        generation = principals.get_generation(token_data.email)
+        async with database.AsyncSessionLocal() as db:
+            db_user = await crud.get_user_by_email_async(db, email=token_data.email)
+            if db_user is None:
+                raise credentials_exception
+            user = schemas.User.model_validate(db_user)
+        principals.cache_principal(token, user, generation, expires_at=payload.get("exp"))
+    if not user.is_active:
         raise credentials_exception
     return user
 
+def require_permission(name: str):
+    """Dependency that allows the request only if the token's permission mask has `name`.
+
+    The user must still exist and be active (get_current_user - answered from the
+    principal cache on repeat requests); the permission itself is checked against
+    the "perm" claim set at login. Returns the token claims.
+    """
+    async def check_permission(
+        payload: dict = Depends(get_token_claims),
+        user: schemas.User = Depends(get_current_user),
+    ) -> dict:
+        bit = await permission_registry.bit(name)
+        if not has_permission(payload.get("perm", 0), bit):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="אין לך הרשאה לבצע פעולה זו",
+            )
+        return payload
+    return check_permission
+
 # Routes
+# throttle_login is resolved before get_read_db: an over-limit attempt gets its 429
+# without opening a session or hashing anything (see backend/ratelimit.py)
 @router.post("/login", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    attempt: LoginAttempt = Depends(throttle_login),
+    db: AsyncSession = Depends(get_read_db),
+):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
+        await attempt.failed()
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="שם המשתמש או הסיסמה שגויים",
@@ -109,7 +172,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": user.email, "perm": await permission_registry.role_mask(user.role_id)},
+        expires_delta=access_token_expires,
     )
     return {
         "access_token": access_token, 
@@ -117,24 +181,13 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         "user": user
     }
 
+DUPLICATE_USER_MESSAGES = {
+    "email": "כתובת המייל כבר רשומה במערכת",
+    "national_id": "מספר הזהות כבר רשום במערכת",
+}
+
 @router.post("/register", response_model=schemas.User)
-async def register_user(user_data: SimpleRegisterRequest, db: Session = Depends(get_db)):
-    # Check if user already exists
-    db_user = crud.get_user_by_email(db, email=user_data.email)
-    if db_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="כתובת המייל כבר רשומה במערכת",
-        )
-    
-    # Check if national ID already exists
-    db_user_by_id = crud.get_user_by_national_id(db, national_id=user_data.national_id)
-    if db_user_by_id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="מספר הזהות כבר רשום במערכת",
-        )
-    
+async def register_user(user_data: SimpleRegisterRequest, db: AsyncSession = Depends(get_async_db)):
     # בדיקה שהסיסמה מספיק חזקה
     if len(user_data.password) < 6:
         raise HTTPException(
@@ -159,13 +212,20 @@ async def register_user(user_data: SimpleRegisterRequest, db: Session = Depends(
         # שדות אופציונליים יקבלו ערכי ברירת מחדל null
     )
     
-    # Create user with citizen role
-    return crud.create_user(db=db, user=user_create_data)
+    # Create user with citizen role - an email or national ID that is already
+    # registered is rejected by its unique constraint, in the same round-trip
+    try:
+        return await crud.create_user_async(db=db, user=user_create_data)
+    except crud.DuplicateUserError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=DUPLICATE_USER_MESSAGES[e.field],
+        )
 
 @router.post("/password-reset-request", status_code=status.HTTP_200_OK)
-async def request_password_reset(request: PasswordResetRequest, db: Session = Depends(get_db)):
+async def request_password_reset(request: PasswordResetRequest, db: AsyncSession = Depends(get_async_db)):
     # Get user by email
-    user = crud.get_user_by_email(db, email=request.email)
+    user = await crud.get_user_by_email_async(db, email=request.email)
     if not user:
         # Don't reveal that the user doesn't exist for security reasons
         return {"message": "אם כתובת המייל קיימת במערכת, הוראות לאיפוס סיסמה נשלחו אליה"}
@@ -179,7 +239,7 @@ async def request_password_reset(request: PasswordResetRequest, db: Session = De
     return {"message": "אם כתובת המייל קיימת במערכת, הוראות לאיפוס סיסמה נשלחו אליה"}
 
 @router.post("/reset-password", status_code=status.HTTP_200_OK)
-async def reset_password(reset_data: PasswordReset, db: Session = Depends(get_db)):
+async def reset_password(reset_data: PasswordReset, db: AsyncSession = Depends(get_async_db)):
     # TODO: Verify token from DB
     # TODO: Update user password
     # For now, we'll just return a success message
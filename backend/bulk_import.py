@@ -0,0 +1,292 @@
+"""
+Bulk citizen import.
+
+Reads CSV or NDJSON UserCreate records and loads them chunk by chunk:
+validate the chunk, hash its passwords in parallel on every core, then insert
+it in one statement - COPY into a staging table + INSERT ... SELECT on
+PostgreSQL, a multi-row INSERT on SQLite. Duplicates are skipped with
+ON CONFLICT DO NOTHING. Every rejected row (validation error or duplicate
+email / national ID) is written to the reject file with its line number.
+
+The hashing processes are one pool per process, created on the first import
+and kept for the next ones (shutdown_executor() at exit). They are started
+with forkserver (spawn where it's missing) rather than forked from the
+multi-threaded server. Only one import runs at a time; another one is
+refused with ImportInProgress instead of competing for the same cores.
+"""
+import csv
+import io
+import json
+import multiprocessing
+import os
+import threading
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from . import crud, models, passwords, rollups, schemas
+from .passwords import hash_password_sync
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 5000))
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", os.cpu_count() or 1))
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+_import_lock = threading.Lock()
+
+# SQLite caps bound parameters per statement (32766), so its multi-row INSERTs are split
+SQLITE_MAX_VARIABLES = 32766
+
+# Columns written for every imported user (id and created_at come from the database).
+# version is set here - COPY and INSERT ... SELECT don't run the model's Python default
+IMPORT_COLUMNS = [
+    "national_id", "first_name", "last_name", "email", "hashed_password",
+    "city", "neighborhood", "street", "building", "entrance", "postal_code",
+    "date_of_birth", "gender", "phone_number", "is_active", "capsule_status", "role_id", "version",
+]
+
+
+@dataclass
+class ImportResult:
+    total: int = 0
+    inserted: int = 0
+    rejected: int = 0
+    chunks: int = 0
+    rejects: List[dict] = field(default_factory=list)
+
+
+def detect_format(filename: str) -> str:
+    return "csv" if filename.lower().endswith(".csv") else "ndjson"
+
+
+def read_records(stream: IO[str], fmt: str) -> Iterator[Tuple[int, object]]:
+    """Yield (line number, record) - record is a dict, or the raw line if it can't be parsed"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            # Empty CSV cells mean "not provided"
+            yield reader.line_num, {k: v for k, v in record.items() if v not in ("", None)}
+        return
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, line
+
+
+def validate_record(record) -> schemas.UserCreate:
+    if not isinstance(record, dict):
+        raise ValueError("Record is not a JSON object")
+    user = schemas.UserCreate(**record)
+    # Same rules as /api/auth/register
+    if len(user.password) < 6:
+        raise ValueError("Password must be at least 6 characters")
+    if not user.national_id.isdigit() or len(user.national_id) != 9:
+        raise ValueError("National ID must be 9 digits")
+    return user
+
+
+def _reject(result: ImportResult, line_number: int, error: str, record):
+    if isinstance(record, dict):
+        record = {k: v for k, v in record.items() if k != "password"}
+    result.rejected += 1
+    result.rejects.append({"line": line_number, "error": error, "record": record})
+
+
+def _insert_postgres(db: Session, rows: List[dict]) -> set:
+    """COPY the chunk into a staging table, then move it over skipping duplicates"""
+    connection = db.connection().connection.dbapi_connection
+    cursor = connection.cursor()
+    columns = ", ".join(IMPORT_COLUMNS)
+    cursor.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS users_import AS SELECT {columns} FROM users WITH NO DATA"
+    )
+    cursor.execute("TRUNCATE users_import")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([r"\N" if row[c] is None else row[c] for c in IMPORT_COLUMNS])
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY users_import ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    cursor.execute(
+        f"INSERT INTO users ({columns}) SELECT {columns} FROM users_import "
+        "ON CONFLICT DO NOTHING RETURNING national_id"
+    )
+    return {national_id for (national_id,) in cursor.fetchall()}
+
+
+def _insert_sqlite(db: Session, rows: List[dict]) -> set:
+    """Chunked multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING (the local stand-in)"""
+    inserted = set()
+    batch_size = SQLITE_MAX_VARIABLES // len(IMPORT_COLUMNS)
+    for start in range(0, len(rows), batch_size):
+        stmt = (
+            sqlite_insert(models.User)
+            .values(rows[start:start + batch_size])
+            .on_conflict_do_nothing()
+            .returning(models.User.national_id)
+        )
+        inserted.update(national_id for (national_id,) in db.execute(stmt))
+    return inserted
+
+
+def _insert_rows(db: Session, rows: List[dict]) -> set:
+    """Insert one chunk, returning the national IDs that were actually inserted"""
+    if db.get_bind().dialect.name == "postgresql":
+        return _insert_postgres(db, rows)
+    return _insert_sqlite(db, rows)
+
+
+def _find_conflict(db: Session, row: dict) -> str:
+    if db.query(models.User.id).filter(models.User.national_id == row["national_id"]).first() is not None:
+        return "National ID already registered"
+    return "Email already registered"
+
+
+def _import_chunk(
+    db: Session,
+    executor: Executor,
+    map_chunksize: int,
+    chunk: List[Tuple[int, object]],
+    role_id: int,
+    result: ImportResult,
+):
+    valid: List[Tuple[int, dict, schemas.UserCreate]] = []
+    for line_number, record in chunk:
+        try:
+            valid.append((line_number, record, validate_record(record)))
+        except ValidationError as e:
+            _reject(result, line_number, "; ".join(
+                f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()
+            ), record)
+        except (TypeError, ValueError) as e:
+            _reject(result, line_number, str(e), record)
+    if not valid:
+        return
+
+    # bcrypt is the expensive part - spread it over every core
+    hashes = executor.map(hash_password_sync, [user.password for _, _, user in valid], chunksize=map_chunksize)
+
+    rows: List[dict] = []
+    seen: Dict[str, int] = {}
+    for (line_number, record, user), hashed_password in zip(valid, hashes):
+        row = crud.build_user(user, role_id, hashed_password)
+        row.version = models.new_row_version()
+        values = {c: getattr(row, c) for c in IMPORT_COLUMNS}
+        rows.append(values)
+        seen.setdefault(values["national_id"], line_number)
+
+    inserted = _insert_rows(db, rows)
+    # Count each inserted national ID once - a repeat inside the chunk was skipped
+    rollups.apply(db, Counter(
+        rollups.user_key(values)
+        for (line_number, _, _), values in zip(valid, rows)
+        if values["national_id"] in inserted and seen[values["national_id"]] == line_number
+    ))
+    db.commit()
+    result.inserted += len(inserted)
+
+    for (line_number, record, _), values in zip(valid, rows):
+        national_id = values["national_id"]
+        if national_id in inserted and seen[national_id] == line_number:
+            continue
+        _reject(result, line_number, _find_conflict(db, values), record)
+
+
+class ImportInProgress(RuntimeError):
+    pass
+
+
+def get_executor(workers: int) -> ProcessPoolExecutor:
+    """The hashing pool, created on first use (again if `workers` changed)"""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is not None and _executor_workers != workers:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            # The workers hash with this process's policy, however they are started
+            _executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=context,
+                initializer=passwords.configure, initargs=(passwords.policy,),
+            )
+            _executor_workers = workers
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def import_users(
+    db: Session,
+    stream: IO[str],
+    fmt: str = "ndjson",
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+    workers: int = IMPORT_WORKERS,
+    rejects_file: Optional[IO[str]] = None,
+) -> ImportResult:
+    """Import UserCreate records from `stream` as citizens - ImportInProgress if another import is running"""
+    if not _import_lock.acquire(blocking=False):
+        raise ImportInProgress("Another import is already running")
+    try:
+        return _import_users(db, stream, fmt, chunk_size, workers, rejects_file)
+    finally:
+        _import_lock.release()
+
+
+def _import_users(
+    db: Session,
+    stream: IO[str],
+    fmt: str,
+    chunk_size: int,
+    workers: int,
+    rejects_file: Optional[IO[str]],
+) -> ImportResult:
+    citizen_role = crud.get_role_by_name_cached(db, "citizen")
+    if not citizen_role:
+        citizen_role = crud.create_role(db, crud.CITIZEN_ROLE)
+    role_id = citizen_role.id
+
+    result = ImportResult()
+    chunk: List[Tuple[int, object]] = []
+    # Hand each worker a few batches per chunk - one password per task costs more in IPC than it saves
+    map_chunksize = max(1, chunk_size // (workers * 4))
+    executor = get_executor(workers)
+    for line_number, record in read_records(stream, fmt):
+        result.total += 1
+        chunk.append((line_number, record))
+        if len(chunk) >= chunk_size:
+            _import_chunk(db, executor, map_chunksize, chunk, role_id, result)
+            result.chunks += 1
+            chunk = []
+            _flush_rejects(result, rejects_file)
+    if chunk:
+        _import_chunk(db, executor, map_chunksize, chunk, role_id, result)
+        result.chunks += 1
+        _flush_rejects(result, rejects_file)
+    return result
+
+
+def _flush_rejects(result: ImportResult, rejects_file: Optional[IO[str]]):
+    """Write this chunk's rejects out so memory doesn't grow with the import"""
+    if rejects_file is None:
+        return
+    for reject in result.rejects:
+        rejects_file.write(json.dumps(reject, default=str, ensure_ascii=False) + "\n")
+    result.rejects.clear()
@@ -1,31 +1,90 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
+from collections import Counter
 from typing import List, Optional
-from passlib.context import CryptContext
-from . import models, schemas
+import os
+from . import models, passwords, principals, rollups, schemas
+from .permissions import registry as permission_registry
+from .cache import MISSING, TTLCache
+from .response_cache import response_cache
+from .pagination import keyset_page, split_page
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Loader options for everything schemas.User serializes (items, role.permissions).
+# Listing N users costs 3 queries in total instead of 1 + 2N lazy loads:
+# users JOIN roles, then one IN query each for items and permissions.
+USER_LOAD_OPTIONS = (
+    selectinload(models.User.items),
+    joinedload(models.User.role).selectinload(models.Role.permissions),
+)
+ROLE_LOAD_OPTIONS = (selectinload(models.Role.permissions),)
+
+# Columns the cursor pagination may sort on - each is NOT NULL and indexed (id is the tie-breaker)
+USER_SORT_KEYS = ("id", "national_id")
+ITEM_SORT_KEYS = ("id",)
+
+# Role cache - roles almost never change, so registration reads the citizen role
+# from memory (permission checks use permissions.registry). create_role,
+# create_permission and assign_permission_to_role clear it; ROLE_CACHE_TTL
+# (seconds, 0 = no expiry) bounds how long another worker may serve a stale copy.
+ROLE_CACHE_TTL = float(os.getenv("ROLE_CACHE_TTL", 0))
+role_cache = TTLCache("roles", ttl=ROLE_CACHE_TTL)
+
+def _invalidate_local_role_cache():
+    role_cache.clear()
+    # Role bitmasks are recomputed on next use
+    permission_registry.invalidate()
+
+def invalidate_role_cache():
+    _invalidate_local_role_cache()
+    # Cached user payloads include the role and its permissions
+    response_cache.invalidate("users")
+
+async def invalidate_role_cache_async():
+    """invalidate_role_cache for the async writes - a shared cache is invalidated without blocking the loop"""
+    _invalidate_local_role_cache()
+    await response_cache.ainvalidate("users")
+
+def get_cache_stats() -> List[dict]:
+    return [role_cache.stats()]
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return passwords.hash_password_sync(password)
 
 # Role operations
 def get_role(db: Session, role_id: int):
-    return db.query(models.Role).filter(models.Role.id == role_id).first()
+    return db.query(models.Role).options(*ROLE_LOAD_OPTIONS).filter(models.Role.id == role_id).first()
 
 def get_role_by_name(db: Session, name: str):
-    return db.query(models.Role).filter(models.Role.name == name).first()
+    return db.query(models.Role).options(*ROLE_LOAD_OPTIONS).filter(models.Role.name == name).first()
 
 def get_roles(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Role).offset(skip).limit(limit).all()
+    return db.query(models.Role).options(*ROLE_LOAD_OPTIONS).offset(skip).limit(limit).all()
 
 def create_role(db: Session, role: schemas.RoleCreate):
     db_role = models.Role(**role.dict())
     db.add(db_role)
     db.commit()
+    invalidate_role_cache()
     db.refresh(db_role)
     return db_role
 
+# Cached role lookups - return schemas.Role snapshots, not session-bound ORM objects
+def get_role_by_name_cached(db: Session, name: str) -> Optional[schemas.Role]:
+    role = role_cache.get(("name", name))
+    if role is MISSING:
+        db_role = get_role_by_name(db, name)
+        if db_role is None:
+            return None
+        role = cache_role(db_role)
+    return role
+
+def cache_role(db_role: models.Role) -> schemas.Role:
+    role = schemas.Role.model_validate(db_role)
+    role_cache.set(("name", role.name), role)
+    return role
+
 # Permission operations
 def get_permission(db: Session, permission_id: int):
     return db.query(models.Permission).filter(models.Permission.id == permission_id).first()
@@ -40,6 +99,7 @@ def create_permission(db: Session, permission: schemas.PermissionCreate):
     db_permission = models.Permission(**permission.dict())
     db.add(db_permission)
     db.commit()
+    invalidate_role_cache()
     db.refresh(db_permission)
     return db_permission
 
@@ -51,38 +111,38 @@ def assign_permission_to_role(db: Session, role_id: int, permission_id: int):
     if db_role and db_permission:
         db_role.permissions.append(db_permission)
         db.commit()
+        invalidate_role_cache()
         db.refresh(db_role)
     return db_role
 
 # User operations
 def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return db.query(models.User).options(*USER_LOAD_OPTIONS).filter(models.User.id == user_id).first()
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    return db.query(models.User).options(*USER_LOAD_OPTIONS).filter(models.User.email == email).first()
 
 def get_user_by_national_id(db: Session, national_id: str):
-    return db.query(models.User).filter(models.User.national_id == national_id).first()
+    return db.query(models.User).options(*USER_LOAD_OPTIONS).filter(models.User.national_id == national_id).first()
 
 def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+    return db.query(models.User).options(*USER_LOAD_OPTIONS).offset(skip).limit(limit).all()
 
-def create_user(db: Session, user: schemas.UserCreate):
-    # Hash the password properly
-    hashed_password = get_password_hash(user.password)
-    
+def get_users_page(db: Session, cursor: Optional[str] = None, limit: int = 100, order_by: str = "id"):
+    query = keyset_page(
+        db.query(models.User).options(*USER_LOAD_OPTIONS), models.User, USER_SORT_KEYS, order_by, cursor, limit
+    )
+    return split_page(query.all(), order_by, limit)
+
+# תפקיד ברירת המחדל למשתמשים חדשים
+CITIZEN_ROLE = schemas.RoleCreate(name="citizen", description="משתמש אזרח רגיל במערכת")
+
+def user_values(user: schemas.UserCreate, role_id: int, hashed_password: str) -> dict:
     # Convert pydantic model to dict and exclude password
     user_data = user.dict(exclude={"password"})
     
-    # מצא את תפקיד האזרח
-    citizen_role = get_role_by_name(db, "citizen")
-    if not citizen_role:
-        # אם תפקיד האזרח לא קיים, צור אותו
-        citizen_role_data = schemas.RoleCreate(name="citizen", description="משתמש אזרח רגיל במערכת")
-        citizen_role = create_role(db, citizen_role_data)
-    
     # קבע תפקיד אזרח למשתמש החדש
-    user_data["role_id"] = citizen_role.id
+    user_data["role_id"] = role_id
     
     # יצירת ערכי ברירת מחדל לשדות חסרים
     default_values = {
@@ -95,11 +155,86 @@ def create_user(db: Session, user: schemas.UserCreate):
         if key not in user_data:
             user_data[key] = value
     
+    user_data["hashed_password"] = hashed_password
+    return user_data
+
+def build_user(user: schemas.UserCreate, role_id: int, hashed_password: str) -> models.User:
     # Create new user with hashed password
-    db_user = models.User(**user_data, hashed_password=hashed_password)
+    return models.User(**user_values(user, role_id, hashed_password))
+
+# Unique columns of users - a registration that repeats one of them fails on its constraint
+USER_UNIQUE_FIELDS = ("email", "national_id")
+
+# Columns of schemas.User, returned by the registration INSERT
+USER_RETURNING = tuple(c for c in models.User.__table__.columns if c.key in schemas.User.model_fields)
+
+class DuplicateUserError(Exception):
+    """The email or national ID of a new user is already registered"""
+
+    def __init__(self, field: str):
+        super().__init__(f"users.{field} is already registered")
+        self.field = field
+
+def duplicate_user_field(error: IntegrityError) -> Optional[str]:
+    """Which unique column an INSERT into users violated, from the driver's message.
+
+    SQLite names the column ("UNIQUE constraint failed: users.email"), PostgreSQL the
+    constraint ("ix_users_email", "users_national_id_key") - both contain the column name.
+    """
+    message = str(error.orig)
+    for field in USER_UNIQUE_FIELDS:
+        if field in message:
+            return field
+    return None
+
+def create_user(db: Session, user: schemas.UserCreate):
+    # Hash the password properly
+    hashed_password = get_password_hash(user.password)
+    
+    # מצא את תפקיד האזרח
+    citizen_role = get_role_by_name_cached(db, "citizen")
+    if not citizen_role:
+        # אם תפקיד האזרח לא קיים, צור אותו
+        citizen_role = create_role(db, CITIZEN_ROLE)
+    
+    db_user = build_user(user, citizen_role.id, hashed_password)
     
     db.add(db_user)
+    rollups.apply(db, Counter([rollups.user_key(db_user)]))
+    db.commit()
+    response_cache.invalidate("users")
+    db.refresh(db_user)
+    return db_user
+
+# A profile update reads the user's rollup key and moves the user to the new one, so
+# the row must not change in between - two concurrent moves from the same old key
+# would both decrement it. Postgres locks the row with FOR UPDATE (OF users only:
+# the role is outer joined, and the nullable side can't be locked). SQLite renders
+# no FOR UPDATE; a no-op UPDATE of the row takes its write lock before the read instead.
+def lock_user_statement(user_id: int):
+    return update(models.User).where(models.User.id == user_id).values(version=models.User.version)
+
+def get_user_for_update(db: Session, user_id: int):
+    if db.get_bind().dialect.name == "sqlite":
+        db.execute(lock_user_statement(user_id))
+    return (
+        db.query(models.User).options(*USER_LOAD_OPTIONS).filter(models.User.id == user_id)
+        .with_for_update(of=models.User).populate_existing().first()
+    )
+
+def update_user(db: Session, user_id: int, changes: schemas.UserUpdate):
+    db_user = get_user_for_update(db, user_id)
+    if db_user is None:
+        return None
+    old_key = rollups.user_key(db_user)
+    for key, value in changes.dict(exclude_unset=True).items():
+        setattr(db_user, key, value)
+    # Moving city / neighborhood / status moves the user between rollup rows
+    rollups.apply(db, rollups.moved(old_key, rollups.user_key(db_user)))
     db.commit()
+    # Cached principals and responses of this user must not outlive the change
+    principals.invalidate_user(db_user.email)
+    response_cache.invalidate("users")
     db.refresh(db_user)
     return db_user
 
@@ -107,9 +242,141 @@ def create_user(db: Session, user: schemas.UserCreate):
 def get_items(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Item).offset(skip).limit(limit).all()
 
+def get_items_page(db: Session, cursor: Optional[str] = None, limit: int = 100, order_by: str = "id"):
+    query = keyset_page(db.query(models.Item), models.Item, ITEM_SORT_KEYS, order_by, cursor, limit)
+    return split_page(query.all(), order_by, limit)
+
 def create_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
     db_item = models.Item(**item.dict(), owner_id=user_id)
     db.add(db_item)
+    # The owner's payload includes its items - move its version (and ETag) on
+    db.execute(update(models.User).where(models.User.id == user_id).values(version=models.new_row_version()))
     db.commit()
+    response_cache.invalidate("users", "items")
     db.refresh(db_item)
-    return db_item 
\ No newline at end of file
+    return db_item 
+
+# Async operations - same queries for the AsyncSession routes.
+# Lazy loading is not available on AsyncSession, so user queries use USER_LOAD_OPTIONS.
+async def get_role_by_name_async(db: AsyncSession, name: str):
+    result = await db.execute(
+        select(models.Role).options(*ROLE_LOAD_OPTIONS).filter(models.Role.name == name)
+    )
+    return result.scalars().first()
+
+async def get_role_by_name_cached_async(db: AsyncSession, name: str) -> Optional[schemas.Role]:
+    role = role_cache.get(("name", name))
+    if role is MISSING:
+        db_role = await get_role_by_name_async(db, name)
+        if db_role is None:
+            return None
+        role = cache_role(db_role)
+    return role
+
+async def create_role_async(db: AsyncSession, role: schemas.RoleCreate):
+    db_role = models.Role(**role.dict())
+    db.add(db_role)
+    await db.commit()
+    await invalidate_role_cache_async()
+    return db_role
+
+async def get_user_async(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(models.User).options(*USER_LOAD_OPTIONS).filter(models.User.id == user_id)
+    )
+    return result.scalars().first()
+
+async def get_user_version_async(db: AsyncSession, user_id: int) -> Optional[int]:
+    """Just the row version - enough to answer a conditional GET"""
+    result = await db.execute(select(models.User.version).filter(models.User.id == user_id))
+    return result.scalar_one_or_none()
+
+async def get_user_by_email_async(db: AsyncSession, email: str):
+    result = await db.execute(
+        select(models.User).options(*USER_LOAD_OPTIONS).filter(models.User.email == email)
+    )
+    return result.scalars().first()
+
+async def create_user_async(db: AsyncSession, user: schemas.UserCreate) -> dict:
+    """Register a citizen with a single INSERT ... RETURNING.
+
+    Duplicates are not looked up first: the unique constraints on email and
+    national_id reject them, also when two registrations race, and the
+    IntegrityError becomes DuplicateUserError. The capsule status rollup is
+    updated in the same transaction. Returns the schemas.User payload
+    as a dict (a new user has no items; the role comes from the role cache).
+    """
+    # Hash in the worker pool so bcrypt doesn't block the event loop
+    hashed_password = await passwords.hash_password(user.password)
+    
+    citizen_role = await get_role_by_name_cached_async(db, "citizen")
+    if not citizen_role:
+        await create_role_async(db, CITIZEN_ROLE)
+        citizen_role = await get_role_by_name_cached_async(db, "citizen")
+    
+    values = user_values(user, citizen_role.id, hashed_password)
+    stmt = insert(models.User).values(**values)
+    try:
+        row = (await db.execute(stmt.returning(*USER_RETURNING))).one()
+        await rollups.apply_async(db, Counter([rollups.user_key(values)]))
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        field = duplicate_user_field(e)
+        if field is None:
+            raise
+        raise DuplicateUserError(field) from e
+    await response_cache.ainvalidate("users")
+    return {**row._asdict(), "items": [], "role": citizen_role}
+
+async def update_password_hash_async(db: AsyncSession, user_id: int, old_hash: str, new_hash: str) -> bool:
+    """Store a rehashed password - only if the hash is still `old_hash`, so a password
+    changed in the meantime wins. The user's representation doesn't change, so the
+    version is kept (overriding its onupdate) and ETags and cached responses stay valid."""
+    result = await db.execute(
+        update(models.User)
+        .where(models.User.id == user_id, models.User.hashed_password == old_hash)
+        .values(hashed_password=new_hash, version=models.User.version)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+async def get_password_hash_stats_async(db: AsyncSession) -> dict:
+    """How many stored hashes the current hashing policy considers stale (one scan of users)"""
+    stale = passwords.stale_hash_condition(models.User.hashed_password)
+    result = await db.execute(
+        select(func.count(models.User.hashed_password), func.count(models.User.id).filter(stale))
+    )
+    total, stale_count = result.one()
+    return {"hashes": total, "stale_hashes": stale_count, "stale_share": stale_count / total if total else 0.0}
+
+async def get_user_for_update_async(db: AsyncSession, user_id: int):
+    if db.get_bind().dialect.name == "sqlite":
+        await db.execute(lock_user_statement(user_id))
+    result = await db.execute(
+        select(models.User).options(*USER_LOAD_OPTIONS).filter(models.User.id == user_id)
+        .with_for_update(of=models.User).execution_options(populate_existing=True)
+    )
+    return result.scalars().first()
+
+async def update_user_async(db: AsyncSession, user_id: int, changes: schemas.UserUpdate):
+    db_user = await get_user_for_update_async(db, user_id)
+    if db_user is None:
+        return None
+    old_key = rollups.user_key(db_user)
+    for key, value in changes.dict(exclude_unset=True).items():
+        setattr(db_user, key, value)
+    await rollups.apply_async(db, rollups.moved(old_key, rollups.user_key(db_user)))
+    await db.commit()
+    principals.invalidate_user(db_user.email)
+    await response_cache.ainvalidate("users")
+    return db_user
+
+async def create_user_item_async(db: AsyncSession, item: schemas.ItemCreate, user_id: int):
+    db_item = models.Item(**item.dict(), owner_id=user_id)
+    db.add(db_item)
+    await db.execute(update(models.User).where(models.User.id == user_id).values(version=models.new_row_version()))
+    await db.commit()
+    await response_cache.ainvalidate("users", "items")
+    await db.refresh(db_item)
+    return db_item
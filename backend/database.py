@@ -1,14 +1,16 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
-import sys
-import inspect
+import threading
 
-# Add parent directory to path to import config.py
-current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
-parent_dir = os.path.dirname(current_dir)
-sys.path.insert(0, parent_dir)
+from . import profiling
+from .pool_metrics import TimedAsyncQueuePool, TimedQueuePool, instrument
+
+# Importing this module never touches the database. The engines and session
+# factories below are created on first use (or by the app's lifespan handler),
+# and startup checks live in check_connection() / prepare_schema().
 
 # Try to import from config, if not available use environment variables
 try:
@@ -20,29 +22,226 @@ except ImportError:
     DB_PORT = os.getenv("DB_PORT", "5432")
     DB_NAME = os.getenv("DB_NAME", "hacaton_db")
 
-# PostgreSQL connection string
-SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+try:
+    from config import (
+        DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_POOL_WARMUP
+    )
+except ImportError:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE = 5, 10, 30, 1800
+    DB_POOL_PRE_PING, DB_POOL_WARMUP = True, True
+
+def env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# Environment variables override config.py for the pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", DB_POOL_SIZE))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", DB_MAX_OVERFLOW))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", DB_POOL_TIMEOUT))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", DB_POOL_RECYCLE))
+DB_POOL_PRE_PING = env_flag("DB_POOL_PRE_PING", DB_POOL_PRE_PING)
+DB_POOL_WARMUP = env_flag("DB_POOL_WARMUP", DB_POOL_WARMUP)
+
+# The sync engine only serves the bulk import, so it can get a smaller pool than the async one
+DB_SYNC_POOL_SIZE = int(os.getenv("DB_SYNC_POOL_SIZE", DB_POOL_SIZE))
+DB_SYNC_MAX_OVERFLOW = int(os.getenv("DB_SYNC_MAX_OVERFLOW", DB_MAX_OVERFLOW))
+
+# Dev/test mode: relationships are lazy="raise", so a missing eager load fails loudly
+STRICT_LOADING = env_flag("DB_STRICT_LOADING", False)
+
+# What the app does with the schema at startup: "verify" (fail if tables are missing),
+# "create" (create missing tables) or "skip"
+try:
+    from config import DB_SCHEMA_MODE
+except ImportError:
+    DB_SCHEMA_MODE = "create"
+DB_SCHEMA_MODE = os.getenv("DB_SCHEMA_MODE", DB_SCHEMA_MODE)
+
+# PostgreSQL connection string (DATABASE_URL overrides it, e.g. sqlite:///./capsule.db for local work)
+SQLALCHEMY_DATABASE_URL = os.getenv(
+    "DATABASE_URL", f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+
+# Async drivers: asyncpg for PostgreSQL, aiosqlite for the local SQLite stand-in
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def get_async_url(url: str) -> str:
+    """Convert a sync database URL into the matching async driver URL"""
+    scheme, sep, rest = url.partition("://")
+    backend = scheme.split("+")[0]
+    return f"{ASYNC_DRIVERS.get(backend, scheme)}{sep}{rest}"
+
+SQLALCHEMY_ASYNC_DATABASE_URL = get_async_url(SQLALCHEMY_DATABASE_URL)
 
-# Create SQLAlchemy engine
+# Read replicas (DATABASE_REPLICA_URLS, comma separated, overrides config.py) - see backend/replicas.py
 try:
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
-    # Test connection
-    with engine.connect() as conn:
-        pass
-except Exception as e:
-    print(f"❌ Database connection error: {str(e)}")
-    print(f"   Connection attempted with: {DB_USER}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
-    print("   Please check your PostgreSQL credentials and make sure the database exists.")
-    print("   If needed, update the config.py file with correct credentials.")
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    from config import DB_REPLICA_URLS
+except ImportError:
+    DB_REPLICA_URLS = []
+if os.getenv("DATABASE_REPLICA_URLS") is not None:
+    DB_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS").split(",") if u.strip()]
+SQLALCHEMY_ASYNC_REPLICA_URLS = [get_async_url(url) for url in DB_REPLICA_URLS]
+
+def get_pool_options(url: str, poolclass, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW) -> dict:
+    """Pool arguments for create_engine - in-memory SQLite keeps its default single-connection pool"""
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    return {
+        "poolclass": poolclass,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+_engine_lock = threading.Lock()
+
+def init_engines():
+    """Create both engines and their session factories (idempotent, no connection is opened)"""
+    global engine, async_engine, SessionLocal, AsyncSessionLocal, pool_metrics, async_pool_metrics
+    global replica_engines, ReplicaSessionLocals, replica_pool_metrics
+    with _engine_lock:
+        if "engine" in globals():
+            return
+        sync_engine = create_engine(
+            SQLALCHEMY_DATABASE_URL,
+            **get_pool_options(SQLALCHEMY_DATABASE_URL, TimedQueuePool, DB_SYNC_POOL_SIZE, DB_SYNC_MAX_OVERFLOW),
+        )
+        new_async_engine = create_async_engine(
+            SQLALCHEMY_ASYNC_DATABASE_URL,
+            **get_pool_options(SQLALCHEMY_ASYNC_DATABASE_URL, TimedAsyncQueuePool),
+        )
+
+        # Pool metrics (checkout wait histogram + pool event counters), served by /api/admin/pool
+        pool_metrics = instrument(sync_engine, "sync")
+        async_pool_metrics = instrument(new_async_engine.sync_engine, "async")
+
+        # Per-request query count / DB time and the slow-query log (see backend/profiling.py)
+        profiling.attach(sync_engine)
+        profiling.attach(new_async_engine.sync_engine)
+
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+        # expire_on_commit=False: attributes must stay readable after commit without implicit IO
+        AsyncSessionLocal = async_sessionmaker(
+            bind=new_async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+
+        # One async engine + session factory per read replica, same pool settings as the primary
+        replica_engines, ReplicaSessionLocals, replica_pool_metrics = [], [], []
+        for i, url in enumerate(SQLALCHEMY_ASYNC_REPLICA_URLS):
+            replica_engine = create_async_engine(url, **get_pool_options(url, TimedAsyncQueuePool))
+            replica_pool_metrics.append(instrument(replica_engine.sync_engine, f"replica-{i}"))
+            profiling.attach(replica_engine.sync_engine)
+            replica_engines.append(replica_engine)
+            ReplicaSessionLocals.append(async_sessionmaker(
+                bind=replica_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+            ))
+
+        async_engine = new_async_engine
+        # Set last - its presence marks the engines as initialised
+        engine = sync_engine
+
+_LAZY_ATTRIBUTES = {
+    "engine", "async_engine", "SessionLocal", "AsyncSessionLocal", "pool_metrics", "async_pool_metrics",
+    "replica_engines", "ReplicaSessionLocals", "replica_pool_metrics",
+}
+
+def __getattr__(name):
+    # `from backend.database import engine` (and friends) creates the engines on first access
+    if name in _LAZY_ATTRIBUTES:
+        init_engines()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 Base = declarative_base()
 
 # Dependency to get DB session
 def get_db():
+    init_engines()
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close() 
+
+# Dependency to get an async DB session
+async def get_async_db():
+    init_engines()
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def check_connection() -> bool:
+    """Startup connectivity check - reports the problem instead of failing the worker"""
+    init_engines()
+    try:
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        return True
+    except Exception as e:
+        print(f"❌ Database connection error: {str(e)}")
+        print(f"   Connection attempted with: {DB_USER}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+        print("   Please check your PostgreSQL credentials and make sure the database exists.")
+        print("   If needed, update the config.py file with correct credentials.")
+        return False
+
+async def prepare_schema(mode: str = DB_SCHEMA_MODE):
+    """Create or verify the tables according to DB_SCHEMA_MODE"""
+    if mode == "skip":
+        return
+    init_engines()
+    async with async_engine.begin() as conn:
+        if mode == "create":
+            await conn.run_sync(Base.metadata.create_all)
+            return
+        existing = await conn.run_sync(lambda sync_conn: set(inspect(sync_conn).get_table_names()))
+    missing = sorted(set(Base.metadata.tables) - existing)
+    if missing:
+        raise RuntimeError(
+            f"Database schema is missing tables: {', '.join(missing)}. "
+            "Run init_roles_db.py or start with DB_SCHEMA_MODE=create."
+        )
+
+async def dispose_engines():
+    if "engine" not in globals():
+        return
+    for replica_engine in replica_engines:
+        await replica_engine.dispose()
+    await async_engine.dispose()
+    engine.dispose()
+
+async def warm_up_async_pool(count: int = DB_POOL_SIZE):
+    """Open `count` connections up front so the first requests don't pay for connecting"""
+    init_engines()
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(await async_engine.connect())
+    finally:
+        for connection in connections:
+            await connection.close()
+
+def get_pool_stats() -> dict:
+    init_engines()
+    return {
+        "settings": {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "sync_pool_size": DB_SYNC_POOL_SIZE,
+            "sync_max_overflow": DB_SYNC_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pre_ping": DB_POOL_PRE_PING,
+        },
+        "async": async_pool_metrics.snapshot(async_engine.sync_engine.pool),
+        "sync": pool_metrics.snapshot(engine.pool),
+        "replicas": [
+            metrics.snapshot(replica_engine.sync_engine.pool)
+            for metrics, replica_engine in zip(replica_pool_metrics, replica_engines)
+        ],
+    }
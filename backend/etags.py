@@ -0,0 +1,49 @@
+"""
+Strong ETags for the user and item endpoints.
+
+Users and items carry a `version` (models.new_row_version) that moves on every
+change, and creating an item also moves its owner's version. A user's ETag is
+its version plus the permission registry's fingerprint (the role and its
+permissions are part of the payload), so GET /api/users/{user_id} with a
+matching If-None-Match costs one single-row query and no serialization.
+
+List pages get an aggregate validator over exactly the rows of the page:
+count, max(version) and sum(id). The sum catches a row leaving the page while
+an older row takes its place, which count and max(version) alone would miss.
+"""
+from typing import Optional, Sequence
+
+from fastapi import Request, Response
+
+# Clients must revalidate, but may keep the body and send If-None-Match
+CACHE_CONTROL = "no-cache"
+
+
+def make_etag(*parts: Optional[int]) -> str:
+    return '"' + ".".join(format(part or 0, "x") for part in parts) + '"'
+
+
+def user_etag(version: int, fingerprint: int) -> str:
+    return make_etag(version, fingerprint)
+
+
+def page_etag(validator: Sequence[Optional[int]], fingerprint: int = 0) -> str:
+    return make_etag(*validator, fingerprint)
+
+
+def matches(request: Request, etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 requires for it)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=headers(etag))
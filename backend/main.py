@@ -1,16 +1,52 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, File, HTTPException, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
 
-from backend import crud, models, schemas
-from backend.database import engine, get_db
-from backend.auth import router as auth_router
+import io
+import os
+import tempfile
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
+from backend import (
+    bulk_import, crud, database, etags, export, models, passwords, principals, projection, replicas, rollups,
+    schemas, search,
+)
+from backend.database import DB_POOL_WARMUP, get_async_db, get_pool_stats, warm_up_async_pool
+from backend.auth import require_permission, router as auth_router
+from backend.metrics import MetricsMiddleware, render_prometheus_async
+from backend.profiling import SQLProfilingMiddleware
+from backend.replicas import ReplicaStickinessMiddleware, get_read_db
+from backend.permissions import registry as permission_registry
+from backend.pagination import InvalidCursor
+from backend.ratelimit import limiter
+from backend.projection import ORJSONResponse
+from backend.response_cache import Entry, response_cache
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Importing this module has no side effects - the database work happens here, once per worker
+    database.init_engines()
+    if await database.check_connection():
+        # Create or verify the tables (DB_SCHEMA_MODE)
+        await database.prepare_schema()
+        if DB_POOL_WARMUP:
+            try:
+                await warm_up_async_pool()
+            except Exception as e:
+                print(f"❌ Connection pool warm-up failed: {str(e)}")
+        try:
+            await permission_registry.ensure_loaded()
+        except Exception as e:
+            print(f"❌ Loading the permission registry failed: {str(e)}")
+    yield
+    passwords.shutdown_executor()
+    bulk_import.shutdown_executor()
+    await database.dispose_engines()
 
-app = FastAPI(title="Backend API", description="FastAPI Backend for React Frontend")
+app = FastAPI(title="Backend API", description="FastAPI Backend for React Frontend", lifespan=lifespan)
 
 # Configure CORS to allow frontend requests
 app.add_middleware(
@@ -19,44 +55,248 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+# Read-your-writes cookie for the replica routing (no-op without replicas)
+app.add_middleware(ReplicaStickinessMiddleware)
+
+# Sampled SQL profiling for the slow query log (Server-Timing header only with SQL_PROFILE_DEBUG)
+app.add_middleware(SQLProfilingMiddleware)
+
+# Per-route request metrics, served at /metrics (outermost, so it times the whole stack)
+app.add_middleware(MetricsMiddleware)
+
 # Include auth router
 app.include_router(auth_router)
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(await render_prometheus_async(), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to the FastAPI backend!"}
 
 @app.post("/api/users/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    try:
+        return await crud.create_user_async(db=db, user=user)
+    except crud.DuplicateUserError as e:
+        detail = "Email already registered" if e.field == "email" else "National ID already registered"
+        raise HTTPException(status_code=400, detail=detail)
+
+# Passing `cursor` (empty for the first page) switches the list endpoints to keyset
+# pagination: the response becomes {"items": [...], "next_cursor": ...}.
+# Without it they keep the old skip/limit behaviour and plain list response.
+# `fields` (comma separated) limits the response to those fields - see backend/projection.py.
+@app.get("/api/users/", response_model=Union[schemas.UserPage, List[schemas.User]])
+async def read_users(
+    request: Request,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    order_by: str = "id",
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db),
+):
+    fingerprint = await permission_registry.get_fingerprint()
+    try:
+        # Revalidation: one aggregate query, 304 before any row is loaded or serialized
+        if request.headers.get("if-none-match"):
+            export.parse_fields(fields, projection.USER_FIELDS)
+            validator = await projection.page_validator(
+                db, models.User, skip, limit, cursor, order_by, crud.USER_SORT_KEYS
+            )
+            etag = etags.page_etag(validator, fingerprint)
+            if etags.matches(request, etag):
+                return etags.not_modified(etag)
+        page, validator = await projection.read_users(
+            db, fields, skip, limit, cursor, order_by, crud.USER_SORT_KEYS
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ORJSONResponse(page, headers=etags.headers(etags.page_etag(validator, fingerprint)))
 
-@app.get("/api/users/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+# Type-ahead search over name, address and phone (see backend/search.py). Declared before
+# /api/users/{user_id}, which would otherwise take "search" for a user id.
+@app.get("/api/users/search")
+async def search_users(
+    q: str,
+    skip: int = 0,
+    limit: int = 20,
+    db: AsyncSession = Depends(get_read_db),
+    claims: dict = Depends(require_permission("manage_users")),
+):
+    try:
+        results = await search.search_users(db, q, skip=skip, limit=limit)
+    except search.InvalidSearch as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ORJSONResponse(results)
+
+def cached_json_response(request: Request, entry: Entry) -> Response:
+    if etags.matches(request, entry.etag):
+        return etags.not_modified(entry.etag)
+    return Response(entry.body, media_type="application/json", headers=etags.headers(entry.etag))
 
+async def cache_fill_session(request: Request, namespace: str):
+    """Session for rendering a cacheable response - cache fills read the primary, so a
+    lagging replica's rows can't be cached past the write that invalidated them"""
+    return await replicas.open_read_session(primary=response_cache.enabled(namespace) or replicas.is_sticky(request))
+
+# The cached endpoints open their session only on a cache miss (see backend/response_cache.py)
 @app.get("/api/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def read_user(user_id: int, request: Request):
+    fingerprint = await permission_registry.get_fingerprint()
+    if request.headers.get("if-none-match") and not response_cache.enabled("users"):
+        async with await replicas.read_session(request) as db:
+            version = await crud.get_user_version_async(db, user_id=user_id)
+        if version is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        etag = etags.user_etag(version, fingerprint)
+        if etags.matches(request, etag):
+            return etags.not_modified(etag)
+
+    async def render():
+        async with await cache_fill_session(request, "users") as db:
+            db_user = await crud.get_user_async(db, user_id=user_id)
+        if db_user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        body = schemas.User.model_validate(db_user).model_dump_json().encode()
+        return body, etags.user_etag(db_user.version, fingerprint)
+
+    return cached_json_response(request, await response_cache.get_or_compute("users", request, render))
+
+@app.patch("/api/users/{user_id}", response_model=schemas.User)
+async def update_user(
+    user_id: int,
+    changes: schemas.UserUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    claims: dict = Depends(require_permission("manage_users")),
+):
+    db_user = await crud.update_user_async(db, user_id=user_id, changes=changes)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 @app.post("/api/users/{user_id}/items/", response_model=schemas.Item)
-def create_item_for_user(
-    user_id: int, item: schemas.ItemCreate, db: Session = Depends(get_db)
+async def create_item_for_user(
+    user_id: int, item: schemas.ItemCreate, db: AsyncSession = Depends(get_async_db)
+):
+    return await crud.create_user_item_async(db=db, item=item, user_id=user_id)
+
+@app.get("/api/items/", response_model=Union[schemas.ItemPage, List[schemas.Item]])
+async def read_items(
+    request: Request,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    order_by: str = "id",
+    fields: Optional[str] = None,
+):
+    export.parse_fields(fields, projection.ITEM_FIELDS)
+    try:
+        if request.headers.get("if-none-match") and not response_cache.enabled("items"):
+            async with await replicas.read_session(request) as db:
+                validator = await projection.page_validator(
+                    db, models.Item, skip, limit, cursor, order_by, crud.ITEM_SORT_KEYS
+                )
+            etag = etags.page_etag(validator)
+            if etags.matches(request, etag):
+                return etags.not_modified(etag)
+
+        async def render():
+            async with await cache_fill_session(request, "items") as db:
+                page, validator = await projection.read_items(
+                    db, fields, skip, limit, cursor, order_by, crud.ITEM_SORT_KEYS
+                )
+            return projection.dumps(page), etags.page_etag(validator)
+
+        entry = await response_cache.get_or_compute("items", request, render)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return cached_json_response(request, entry)
+
+@app.get("/api/export/users")
+async def export_users(
+    format: str = "ndjson",
+    fields: Optional[str] = None,
+    claims: dict = Depends(require_permission("manage_users")),
+):
+    return export.export_response(models.User, export.USER_EXPORT_FIELDS, fields, format, "users")
+
+@app.get("/api/export/items")
+async def export_items(
+    format: str = "ndjson",
+    fields: Optional[str] = None,
+    claims: dict = Depends(require_permission("manage_users")),
+):
+    return export.export_response(models.Item, export.ITEM_EXPORT_FIELDS, fields, format, "items")
+
+# Citizens per capsule status, city and neighborhood - read from the rollup table
+# (backend/rollups.py), so the cost doesn't depend on the number of citizens
+@app.get("/api/stats/capsule-status")
+async def read_capsule_status_counts(
+    city: Optional[str] = None,
+    neighborhood: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db),
+    claims: dict = Depends(require_permission("manage_users")),
+):
+    return await rollups.read_counts(db, city=city, neighborhood=neighborhood)
+
+def run_user_import(upload: UploadFile) -> dict:
+    fmt = bulk_import.detect_format(upload.filename or "")
+    rejects_dir = os.getenv("IMPORT_REJECTS_DIR", tempfile.gettempdir())
+    fd, rejects_path = tempfile.mkstemp(prefix="citizens-", suffix=".rejects.ndjson", dir=rejects_dir)
+    db = database.SessionLocal()
+    try:
+        with io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="") as stream, \
+                os.fdopen(fd, "w", encoding="utf-8") as rejects_file:
+            result = bulk_import.import_users(db, stream, fmt, rejects_file=rejects_file)
+    except bulk_import.ImportInProgress:
+        os.remove(rejects_path)
+        raise
+    finally:
+        db.close()
+    if not result.rejected:
+        os.remove(rejects_path)
+    return {
+        "total": result.total,
+        "inserted": result.inserted,
+        "rejected": result.rejected,
+        "rejects_file": rejects_path if result.rejected else None,
+    }
+
+@app.post("/api/admin/import/users")
+async def import_users(
+    file: UploadFile = File(...),
+    claims: dict = Depends(require_permission("admin_access")),
 ):
-    return crud.create_user_item(db=db, item=item, user_id=user_id)
+    # The import is CPU and sync-DB bound - keep it off the event loop
+    try:
+        return await run_in_threadpool(run_user_import, file)
+    except bulk_import.ImportInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
-@app.get("/api/items/", response_model=List[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    items = crud.get_items(db, skip=skip, limit=limit)
-    return items
+@app.get("/api/admin/pool")
+async def read_pool_stats(claims: dict = Depends(require_permission("admin_access"))):
+    return {**get_pool_stats(), "replica_status": replicas.get_status()}
+
+@app.get("/api/admin/cache")
+async def read_cache_stats(claims: dict = Depends(require_permission("admin_access"))):
+    return crud.get_cache_stats() + [principals.principal_cache.stats(), response_cache.stats()]
+
+@app.get("/api/admin/throttle")
+async def read_throttle_stats(claims: dict = Depends(require_permission("admin_access"))):
+    return limiter.stats()
+
+# Hashing policy, rehash-on-login counters and the share of stored hashes it considers stale
+@app.get("/api/admin/passwords")
+async def read_password_stats(
+    claims: dict = Depends(require_permission("admin_access")),
+    db: AsyncSession = Depends(get_read_db),
+):
+    return {**passwords.get_stats(), **await crud.get_password_hash_stats_async(db)}
 
 if __name__ == "__main__":
     import uvicorn
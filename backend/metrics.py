@@ -0,0 +1,303 @@
+"""
+Request metrics in Prometheus text format.
+
+MetricsMiddleware records, per route template and method (e.g. GET
+/api/users/{user_id}, never the raw path): request count by status, a latency
+histogram, in-flight requests and a response size histogram. Each
+(route, method) gets one RouteSeries with pre-allocated bucket arrays the first
+time it is seen, and the hot path only does nested dict lookups and integer
+increments.
+
+Multiple uvicorn workers: set METRICS_DIR to a directory shared by the
+workers. Each worker writes its snapshot there (at most every
+METRICS_FLUSH_INTERVAL seconds) and /metrics merges every worker's file, so
+the scrape sees the whole server whichever worker answers it. Empty the
+directory when the server (not a single worker) restarts. The snapshot is
+taken on the event loop; the files are written and read on a worker thread,
+so a slow disk never stalls requests.
+"""
+import asyncio
+import bisect
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from starlette.routing import Match
+
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1))
+
+# Histogram upper bounds (Prometheus "le"), +Inf is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class RouteSeries:
+    __slots__ = ("route", "method", "latency_counts", "latency_sum", "size_counts", "size_sum",
+                 "statuses", "in_flight")
+
+    def __init__(self, route: str, method: str):
+        self.route = route
+        self.method = method
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.size_counts = [0] * (len(SIZE_BUCKETS) + 1)
+        self.size_sum = 0
+        self.statuses: Dict[int, int] = {}
+        self.in_flight = 0
+
+    def observe(self, status_code: int, seconds: float, size: int):
+        self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.latency_sum += seconds
+        self.size_counts[bisect.bisect_left(SIZE_BUCKETS, size)] += 1
+        self.size_sum += size
+        self.statuses[status_code] = self.statuses.get(status_code, 0) + 1
+
+    def snapshot(self) -> dict:
+        return {
+            "route": self.route,
+            "method": self.method,
+            "latency_counts": list(self.latency_counts),
+            "latency_sum": self.latency_sum,
+            "size_counts": list(self.size_counts),
+            "size_sum": self.size_sum,
+            "statuses": {str(k): v for k, v in self.statuses.items()},
+            "in_flight": self.in_flight,
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        # route template -> method -> series
+        self.series: Dict[str, Dict[str, RouteSeries]] = {}
+        self._last_flush = 0.0
+        self._flushing = False
+
+    def get_series(self, route: str, method: str) -> RouteSeries:
+        by_method = self.series.get(route)
+        if by_method is None:
+            by_method = self.series[route] = {}
+        series = by_method.get(method)
+        if series is None:
+            series = by_method[method] = RouteSeries(route, method)
+        return series
+
+    def snapshot(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "series": [s.snapshot() for by_method in self.series.values() for s in by_method.values()],
+        }
+
+    def maybe_flush(self, force: bool = False):
+        """Start writing this worker's snapshot to METRICS_DIR on a worker thread
+        (rate limited unless forced, one write at a time) - call on the event loop"""
+        if not METRICS_DIR or self._flushing:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < METRICS_FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+        self._flushing = True
+        # Taken here, on the loop that updates the series; only the file I/O moves off it
+        future = asyncio.get_running_loop().run_in_executor(None, write_snapshot, self.snapshot())
+        future.add_done_callback(self._flushed)
+
+    def _flushed(self, future):
+        self._flushing = False
+        if not future.cancelled() and future.exception() is not None:
+            # A failed write is retried on the next flush; the scrape just sees older numbers
+            self._last_flush = 0.0
+
+
+registry = MetricsRegistry()
+
+
+def write_snapshot(snapshot: dict):
+    path = os.path.join(METRICS_DIR, f"worker-{snapshot['pid']}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def _flatten_routes(routes):
+    """Routes with a path template - newer FastAPI wraps include_router() in a pathless route"""
+    for route in routes:
+        if getattr(route, "path", None) is not None:
+            yield route
+        elif hasattr(route, "effective_candidates"):
+            yield from _flatten_routes(route.effective_candidates())
+        elif hasattr(route, "routes"):
+            yield from _flatten_routes(route.routes)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware - no per-request Request/Response objects"""
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def match_route(self, scope) -> str:
+        if self.routes is None:
+            self.routes = list(_flatten_routes(scope["app"].router.routes))
+        partial = None
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match is Match.FULL:
+                return route.path
+            if match is Match.PARTIAL and partial is None:
+                partial = route.path
+        return partial or UNMATCHED_ROUTE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        series = registry.get_series(self.match_route(scope), scope["method"])
+        status_code = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status_code, size
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        series.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            series.in_flight -= 1
+            series.observe(status_code, time.perf_counter() - start, size)
+            registry.maybe_flush()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect_snapshots(own: Optional[dict] = None) -> List[dict]:
+    """This worker's live snapshot plus, with METRICS_DIR, every other worker's file (blocking)"""
+    if own is None:
+        own = registry.snapshot()
+    snapshots = [own]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        for name in os.listdir(METRICS_DIR):
+            if not name.startswith("worker-") or not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if snapshot.get("pid") == own["pid"]:
+                continue
+            # Counters of exited workers still count, their in-flight gauge does not
+            if not _pid_alive(snapshot.get("pid", 0)):
+                for series in snapshot["series"]:
+                    series["in_flight"] = 0
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def _merge(snapshots: List[dict]) -> Dict[tuple, dict]:
+    merged: Dict[tuple, dict] = {}
+    for snapshot in snapshots:
+        for series in snapshot["series"]:
+            key = (series["route"], series["method"])
+            total = merged.get(key)
+            if total is None:
+                merged[key] = {
+                    **series,
+                    "latency_counts": list(series["latency_counts"]),
+                    "size_counts": list(series["size_counts"]),
+                    "statuses": dict(series["statuses"]),
+                }
+                continue
+            for i, count in enumerate(series["latency_counts"]):
+                total["latency_counts"][i] += count
+            for i, count in enumerate(series["size_counts"]):
+                total["size_counts"][i] += count
+            total["latency_sum"] += series["latency_sum"]
+            total["size_sum"] += series["size_sum"]
+            total["in_flight"] += series["in_flight"]
+            for status_code, count in series["statuses"].items():
+                total["statuses"][status_code] = total["statuses"].get(status_code, 0) + count
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram(lines: List[str], name: str, labels: str, bounds, counts, total_sum):
+    cumulative = 0
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    cumulative += counts[-1]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+    lines.append(f"{name}_sum{{{labels}}} {total_sum}")
+    lines.append(f"{name}_count{{{labels}}} {cumulative}")
+
+
+def render_prometheus(snapshots: Optional[List[dict]] = None) -> str:
+    merged = _merge(collect_snapshots() if snapshots is None else snapshots)
+    series = [merged[key] for key in sorted(merged)]
+    labels = {key: f'method="{key[1]}",route="{_escape(key[0])}"' for key in merged}
+
+    lines = [
+        "# HELP http_requests_total Requests handled, by route template, method and status.",
+        "# TYPE http_requests_total counter",
+    ]
+    for s in series:
+        key_labels = labels[(s["route"], s["method"])]
+        for status_code, count in sorted(s["statuses"].items()):
+            lines.append(f'http_requests_total{{{key_labels},status="{status_code}"}} {count}')
+
+    lines += [
+        "# HELP http_request_duration_seconds Request latency, by route template and method.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for s in series:
+        _histogram(lines, "http_request_duration_seconds", labels[(s["route"], s["method"])],
+                   LATENCY_BUCKETS, s["latency_counts"], s["latency_sum"])
+
+    lines += [
+        "# HELP http_requests_in_flight Requests currently being handled.",
+        "# TYPE http_requests_in_flight gauge",
+    ]
+    for s in series:
+        lines.append(f'http_requests_in_flight{{{labels[(s["route"], s["method"])]}}} {s["in_flight"]}')
+
+    lines += [
+        "# HELP http_response_size_bytes Response body size, by route template and method.",
+        "# TYPE http_response_size_bytes histogram",
+    ]
+    for s in series:
+        _histogram(lines, "http_response_size_bytes", labels[(s["route"], s["method"])],
+                   SIZE_BUCKETS, s["size_counts"], s["size_sum"])
+
+    return "\n".join(lines) + "\n"
+
+
+async def render_prometheus_async() -> str:
+    """render_prometheus() for the /metrics route - the other workers' files are read off the event loop"""
+    own = registry.snapshot()
+    registry.maybe_flush(force=True)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: render_prometheus(collect_snapshots(own)))
@@ -1,15 +1,30 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Text, DateTime, Table
+import time
+
+from sqlalchemy import (
+    DDL, BigInteger, Boolean, Column, ForeignKey, Index, Integer, SmallInteger, String, Text, DateTime, Table, event,
+)
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
+
+from .database import Base, STRICT_LOADING
 
-from .database import Base
+# In strict loading mode (dev/test) any relationship that was not eager loaded raises
+# instead of silently issuing one query per row
+RELATIONSHIP_LAZY = "raise" if STRICT_LOADING else "select"
+
+def new_row_version() -> int:
+    """Row versions come from the clock, so the latest change anywhere has the highest
+    version and a page's max(version) moves whenever one of its rows changes (see backend/etags.py)"""
+    return time.time_ns()
 
 # Association table for role-permission many-to-many relationship
 role_permission = Table(
     'role_permission',
     Base.metadata,
     Column('role_id', Integer, ForeignKey('roles.id'), primary_key=True),
-    Column('permission_id', Integer, ForeignKey('permissions.id'), primary_key=True)
+    Column('permission_id', Integer, ForeignKey('permissions.id'), primary_key=True),
+    # The primary key (role_id, permission_id) only serves lookups by role
+    Index('ix_role_permission_permission_id', 'permission_id'),
 )
 
 class Role(Base):
@@ -20,8 +35,8 @@ class Role(Base):
     description = Column(Text)
     
     # Relationships
-    users = relationship("User", back_populates="role")
-    permissions = relationship("Permission", secondary=role_permission, back_populates="roles")
+    users = relationship("User", back_populates="role", lazy=RELATIONSHIP_LAZY)
+    permissions = relationship("Permission", secondary=role_permission, back_populates="roles", lazy=RELATIONSHIP_LAZY)
 
 class Permission(Base):
     __tablename__ = "permissions"
@@ -31,10 +46,26 @@ class Permission(Base):
     description = Column(Text)
     
     # Relationships
-    roles = relationship("Role", secondary=role_permission, back_populates="permissions")
+    roles = relationship("Role", secondary=role_permission, back_populates="permissions", lazy=RELATIONSHIP_LAZY)
 
 class User(Base):
     __tablename__ = "users"
+    # national_id and email are served by their unique indexes, id by the primary key.
+    # verify_indexes.py checks the query plans of the crud lookups against these.
+    __table_args__ = (
+        # Users of a role (and the roles.id foreign key)
+        Index("ix_users_role_id", "role_id"),
+        # Users in a capsule status, paged by id
+        Index("ix_users_capsule_status_id", "capsule_status", "id"),
+        # Capsule status counts per city / neighborhood
+        Index("ix_users_city_neighborhood_status", "city", "neighborhood", "capsule_status"),
+        # Active users paged by id - partial, deactivated users are left out
+        Index(
+            "ix_users_active_id", "id",
+            postgresql_where=text("is_active"),
+            sqlite_where=text("is_active = 1"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     national_id = Column(String(20), unique=True, nullable=False)
@@ -60,22 +91,101 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     capsule_status = Column(String(20), default="not_ready")
     created_at = Column(DateTime, server_default=func.now())
+    # Bumped on every change to the user or their items - the ETag of the user's payload
+    version = Column(BigInteger, nullable=False, default=new_row_version, onupdate=new_row_version, server_default="0")
     
     # Foreign keys
     role_id = Column(Integer, ForeignKey("roles.id"))
     
     # Relationships
-    role = relationship("Role", back_populates="users")
-    items = relationship("Item", back_populates="owner")
+    role = relationship("Role", back_populates="users", lazy=RELATIONSHIP_LAZY)
+    items = relationship("Item", back_populates="owner", lazy=RELATIONSHIP_LAZY)
 
 class Item(Base):
     __tablename__ = "items"
+    __table_args__ = (
+        # A user's items (selectinload / IN lookups by owner), in id order
+        Index("ix_items_owner_id_id", "owner_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     description = Column(String)
     is_active = Column(Boolean, default=True)
+    version = Column(BigInteger, nullable=False, default=new_row_version, onupdate=new_row_version, server_default="0")
 
     # Example of a relationship
     owner_id = Column(Integer, ForeignKey("users.id"))
-    owner = relationship("User", back_populates="items") 
\ No newline at end of file
+    owner = relationship("User", back_populates="items", lazy=RELATIONSHIP_LAZY)
+
+class CapsuleStatusCount(Base):
+    """Citizens per (city, neighborhood, capsule_status) - maintained by backend/rollups.py.
+
+    A missing city, neighborhood or status is stored as "" (key columns can't be NULL).
+    Each key's count is spread over `shard` rows (summed on read), so concurrent
+    writers of the same key rarely wait for the same row lock.
+    """
+    __tablename__ = "capsule_status_counts"
+
+    city = Column(String(100), primary_key=True)
+    neighborhood = Column(String(100), primary_key=True)
+    capsule_status = Column(String(20), primary_key=True)
+    shard = Column(SmallInteger, primary_key=True, default=0)
+    count = Column(BigInteger, nullable=False, default=0)
+
+
+# Citizen search (backend/search.py) over these columns - pg_trgm on PostgreSQL,
+# an FTS5 index kept in sync by triggers on SQLite. Created with the users table;
+# create_search_index.py adds it to an existing database.
+SEARCH_COLUMNS = ("first_name", "last_name", "city", "street", "phone_number")
+
+def _search_value(column: str, prefix: str) -> str:
+    # Phone numbers are indexed as digits only, so "0501234567" finds "050-123 4567"
+    if column == "phone_number":
+        return f"replace(replace({prefix}{column}, '-', ''), ' ', '')"
+    return f"{prefix}{column}"
+
+def search_document(prefix: str = "") -> str:
+    """The text the trigram index covers - queries must use exactly this expression to hit it"""
+    return "lower(" + " || ' ' || ".join(
+        f"coalesce({_search_value(c, prefix)}, '')" for c in SEARCH_COLUMNS
+    ) + ")"
+
+_fts_columns = ", ".join(SEARCH_COLUMNS)
+_fts_new = ", ".join(_search_value(c, "new.") for c in SEARCH_COLUMNS)
+_fts_old = ", ".join(_search_value(c, "old.") for c in SEARCH_COLUMNS)
+# Fills users_fts from existing rows (create_search_index.py)
+SQLITE_SEARCH_FILL = (
+    f"INSERT INTO users_fts(rowid, {_fts_columns}) "
+    f"SELECT id, {', '.join(_search_value(c, '') for c in SEARCH_COLUMNS)} FROM users"
+)
+
+POSTGRES_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # GiST rather than GIN: besides the LIKE / <% filter it returns rows in <<-> distance
+    # order, so the best matches are read first and the scan stops at the rank window
+    f"CREATE INDEX IF NOT EXISTS ix_users_search_gist ON users USING gist (({search_document()}) gist_trgm_ops)",
+    "DROP INDEX IF EXISTS ix_users_search_trgm",
+)
+SQLITE_SEARCH_DDL = (
+    # Contentless: only the tokens (and their 2/3 letter prefixes) are stored, the rows stay in users.
+    # Deleting from it needs the indexed values, which the triggers pass from old.*
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5({_fts_columns}, content='', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    # bm25 with the names weighted above the address, used by ORDER BY rank
+    "INSERT INTO users_fts(users_fts, rank) VALUES ('rank', 'bm25(3.0, 3.0, 1.0, 1.0, 1.0)')",
+    f"CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN "
+    f"INSERT INTO users_fts(rowid, {_fts_columns}) VALUES (new.id, {_fts_new}); END",
+    f"CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN "
+    f"INSERT INTO users_fts(users_fts, rowid, {_fts_columns}) VALUES ('delete', old.id, {_fts_old}); END",
+    f"CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF {_fts_columns} ON users BEGIN "
+    f"INSERT INTO users_fts(users_fts, rowid, {_fts_columns}) VALUES ('delete', old.id, {_fts_old}); "
+    f"INSERT INTO users_fts(rowid, {_fts_columns}) VALUES (new.id, {_fts_new}); END",
+)
+
+for _statement in POSTGRES_SEARCH_DDL:
+    event.listen(User.__table__, "after_create", DDL(_statement).execute_if(dialect="postgresql"))
+for _statement in SQLITE_SEARCH_DDL:
+    event.listen(User.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+# The triggers go with the table, the FTS table must be dropped explicitly
+event.listen(User.__table__, "before_drop", DDL("DROP TABLE IF EXISTS users_fts").execute_if(dialect="sqlite"))
@@ -0,0 +1,66 @@
+"""
+Keyset (cursor) pagination.
+
+A cursor is an opaque, URL-safe token holding the sort key and the last row's
+(sort value, id). The next page is `WHERE (sort_col, id) > (value, id)
+ORDER BY sort_col, id LIMIT n`, which walks the index instead of skipping
+rows, so every page costs the same and inserts don't shift page boundaries.
+"""
+import base64
+import json
+from typing import Any, Optional, Sequence, Tuple
+
+from sqlalchemy import tuple_
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(order_by: str, value: Any, row_id: int) -> str:
+    payload = json.dumps([order_by, value, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, order_by: str) -> Optional[Tuple[Any, int]]:
+    """Return the (sort value, id) to continue after, or None for the first page"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key, value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    if key != order_by or not isinstance(row_id, int):
+        raise InvalidCursor("Cursor does not match the requested sort order")
+    return value, row_id
+
+
+def keyset_page(stmt, model, sort_keys: Sequence[str], order_by: str, cursor: Optional[str], limit: int):
+    """Apply keyset ordering/filtering to a select() over `model`.
+
+    Fetches one extra row so the caller can tell whether there is a next page.
+    """
+    if order_by not in sort_keys:
+        raise InvalidCursor(f"order_by must be one of: {', '.join(sort_keys)}")
+    sort_column = getattr(model, order_by)
+    after = decode_cursor(cursor, order_by)
+    if order_by == "id":
+        if after is not None:
+            stmt = stmt.filter(model.id > after[1])
+        stmt = stmt.order_by(model.id)
+    else:
+        if after is not None:
+            stmt = stmt.filter(tuple_(sort_column, model.id) > tuple_(*after))
+        stmt = stmt.order_by(sort_column, model.id)
+    return stmt.limit(limit + 1)
+
+
+def split_page(rows: Sequence, order_by: str, limit: int):
+    """Trim the extra row fetched by keyset_page and build the next cursor"""
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(order_by, getattr(last, order_by), last.id)
@@ -0,0 +1,223 @@
+"""
+Password hashing policy and executor.
+
+The one place that decides how passwords are hashed - crud, auth and the bulk
+import all go through it.
+
+Policy: PASSWORD_HASH_SCHEME is "bcrypt" (default) or "argon2" (needs
+argon2-cffi; PASSWORD_ARGON2_MEMORY_KB and PASSWORD_ARGON2_PARALLELISM).
+PASSWORD_HASH_COST is the bcrypt cost (log2 rounds) or the argon2 time cost,
+the same for every worker and host. calibrate() suggests one: it times a hash
+at the minimum cost and picks the highest cost that still hashes within
+PASSWORD_HASH_TARGET_MS here. It is run once, by calibrate_password_hash.py,
+which writes the result to config.py - never per worker, whose picks could
+differ and rehash each other's hashes.
+
+A hash made with another scheme or a lower cost is stale: the login route
+verifies with verify_and_update(), which also returns a new hash in that case,
+and stores it. bcrypt hashes above the current cost are left alone; argon2
+hashes must match the parameters exactly.
+stale_hash_condition() is the SQL form of the same rule, for counting them.
+
+Executor: a hash costs ~250ms of CPU, so the async routes must never run it on
+the event loop. Hashing and verification go through a bounded worker pool
+instead; when the pool and its queue are full the request is rejected with 503
+rather than piling up behind the CPU.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from sqlalchemy import and_, func, not_
+
+try:
+    from config import (
+        PASSWORD_HASH_SCHEME, PASSWORD_HASH_COST, PASSWORD_HASH_TARGET_MS,
+        PASSWORD_ARGON2_MEMORY_KB, PASSWORD_ARGON2_PARALLELISM,
+    )
+except ImportError:
+    PASSWORD_HASH_SCHEME, PASSWORD_HASH_COST, PASSWORD_HASH_TARGET_MS = "bcrypt", 12, 250
+    PASSWORD_ARGON2_MEMORY_KB, PASSWORD_ARGON2_PARALLELISM = 19456, 1
+
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", PASSWORD_HASH_SCHEME)
+PASSWORD_HASH_COST = int(os.getenv("PASSWORD_HASH_COST", PASSWORD_HASH_COST))
+PASSWORD_HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", PASSWORD_HASH_TARGET_MS))
+PASSWORD_ARGON2_MEMORY_KB = int(os.getenv("PASSWORD_ARGON2_MEMORY_KB", PASSWORD_ARGON2_MEMORY_KB))
+PASSWORD_ARGON2_PARALLELISM = int(os.getenv("PASSWORD_ARGON2_PARALLELISM", PASSWORD_ARGON2_PARALLELISM))
+
+SCHEMES = ("bcrypt", "argon2")
+# Range calibrate() picks from
+MIN_COST = {"bcrypt": 10, "argon2": 2}
+MAX_COST = {"bcrypt": 16, "argon2": 16}
+CALIBRATION_RUNS = 2
+
+
+class HashPolicy(NamedTuple):
+    scheme: str
+    cost: int
+    memory_kb: int = PASSWORD_ARGON2_MEMORY_KB
+    parallelism: int = PASSWORD_ARGON2_PARALLELISM
+
+    def prefix(self) -> str:
+        """Start of every argon2 hash made under this policy (its parameters)"""
+        return f"$argon2id$v=19$m={self.memory_kb},t={self.cost},p={self.parallelism}$"
+
+
+def build_context(policy: HashPolicy) -> CryptContext:
+    # Both schemes are known so a switch either way keeps every stored hash verifiable;
+    # deprecated="auto" makes the other one stale, so those hashes get upgraded
+    schemes = [policy.scheme] + [scheme for scheme in SCHEMES if scheme != policy.scheme]
+    if policy.scheme == "bcrypt":
+        # min_rounds makes lower costs stale; max_rounds keeps higher ones current
+        settings = dict(bcrypt__rounds=policy.cost, bcrypt__min_rounds=policy.cost, bcrypt__max_rounds=31)
+    elif policy.scheme == "argon2":
+        try:
+            import argon2  # noqa: F401 - passlib's argon2 backend
+        except ImportError:
+            raise RuntimeError("PASSWORD_HASH_SCHEME=argon2 needs argon2-cffi: pip install argon2-cffi")
+        settings = dict(
+            argon2__type="id", argon2__memory_cost=policy.memory_kb, argon2__parallelism=policy.parallelism,
+            argon2__rounds=policy.cost, argon2__min_rounds=policy.cost,
+        )
+    else:
+        raise ValueError(f"Unknown PASSWORD_HASH_SCHEME {policy.scheme!r} (bcrypt or argon2)")
+    return CryptContext(schemes=schemes, deprecated="auto", **settings)
+
+
+def configure(new_policy: HashPolicy):
+    """Switch to `new_policy` - also the initializer of the process pools"""
+    global policy, pwd_context
+    pwd_context = build_context(new_policy)
+    policy = new_policy
+
+
+def time_hash(context: CryptContext) -> float:
+    start = time.perf_counter()
+    context.hash("calibration-password")
+    return time.perf_counter() - start
+
+
+def calibrate(target_ms: float = PASSWORD_HASH_TARGET_MS, scheme: str = PASSWORD_HASH_SCHEME) -> HashPolicy:
+    """The highest cost of `scheme` that hashes within target_ms on this host"""
+    low = HashPolicy(scheme, MIN_COST[scheme])
+    context = build_context(low)
+    seconds = min(time_hash(context) for _ in range(CALIBRATION_RUNS))
+    ratio = target_ms / 1000 / seconds
+    if scheme == "bcrypt":
+        # Each step doubles the work
+        cost = low.cost + math.floor(math.log2(ratio))
+    else:
+        # argon2 time cost is linear
+        cost = math.floor(low.cost * ratio)
+    return low._replace(cost=max(MIN_COST[scheme], min(MAX_COST[scheme], cost)))
+
+
+def stale_hash_condition(column):
+    """SQL condition for hashes that verify_and_update() would replace under the current policy"""
+    if policy.scheme == "bcrypt":
+        # $2b$12$... - the cost is always two digits, so it compares as a string
+        current = and_(column.like("$2%"), func.substr(column, 5, 2) >= f"{policy.cost:02d}")
+    else:
+        current = column.startswith(policy.prefix(), autoescape=True)
+    return not_(current)
+
+
+policy: HashPolicy = None
+pwd_context: CryptContext = None
+configure(HashPolicy(PASSWORD_HASH_SCHEME, PASSWORD_HASH_COST))
+
+# Executor configuration - "thread" (bcrypt releases the GIL) or "process"
+HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+# Jobs allowed to wait for a free worker before we start returning 503
+HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", HASH_WORKERS * 4))
+HASH_RETRY_AFTER = os.getenv("PASSWORD_HASH_RETRY_AFTER", "1")
+
+_executor: Executor = None
+_pending = 0
+_lock = threading.Lock()
+# Logins that found a stale hash, and how storing its replacement went
+_rehash_stats = {"stale_logins": 0, "rehashed": 0, "rehash_errors": 0}
+
+
+def hash_password_sync(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_and_update_sync(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """(verified, new hash or None) - the new hash only when the password is right and the hash stale"""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+def get_executor() -> Executor:
+    """Create the worker pool on first use"""
+    global _executor
+    with _lock:
+        if _executor is None:
+            if HASH_EXECUTOR == "process":
+                _executor = ProcessPoolExecutor(
+                    max_workers=HASH_WORKERS, initializer=configure, initargs=(policy,)
+                )
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=HASH_WORKERS, thread_name_prefix="password-hash"
+                )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def record_rehash(stored: bool):
+    _rehash_stats["stale_logins"] += 1
+    _rehash_stats["rehashed" if stored else "rehash_errors"] += 1
+
+
+def get_stats() -> dict:
+    return {
+        "scheme": policy.scheme,
+        "cost": policy.cost,
+        "target_ms": PASSWORD_HASH_TARGET_MS,
+        **_rehash_stats,
+        "executor": HASH_EXECUTOR,
+        "workers": HASH_WORKERS,
+        "queue_size": HASH_QUEUE_SIZE,
+        "pending": _pending,
+    }
+
+
+async def _run(fn, *args):
+    global _pending
+    with _lock:
+        if _pending >= HASH_WORKERS + HASH_QUEUE_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="השרת עמוס כרגע, נסה שוב בעוד מספר שניות",
+                headers={"Retry-After": HASH_RETRY_AFTER},
+            )
+        _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), fn, *args)
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run(hash_password_sync, password)
+
+
+async def verify_and_update(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return await _run(verify_and_update_sync, plain_password, hashed_password)
@@ -0,0 +1,94 @@
+"""
+Permission registry.
+
+Every Permission gets a bit (its id), every role a precomputed bitmask of its
+permissions. The mask is embedded in the access token at login, so
+require_permission() checks a request with one AND on the token claim
+instead of joining users, roles and role_permission.
+
+The registry is loaded per worker and reloaded lazily, on the next use after
+crud.invalidate_role_cache() (a role/permission write in this worker) or
+after PERMISSION_REGISTRY_TTL seconds. A write made by another worker or
+outside the API is therefore seen within PERMISSION_REGISTRY_TTL seconds.
+Tokens that were already issued keep their mask until they expire.
+"""
+import asyncio
+import os
+import time
+import zlib
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select
+
+from . import database, models
+
+try:
+    from config import PERMISSION_REGISTRY_TTL
+except ImportError:
+    PERMISSION_REGISTRY_TTL = 30
+
+PERMISSION_REGISTRY_TTL = float(os.getenv("PERMISSION_REGISTRY_TTL", PERMISSION_REGISTRY_TTL))
+
+
+class PermissionRegistry:
+    def __init__(self):
+        self.bits: Dict[str, int] = {}
+        self.role_masks: Dict[int, int] = {}
+        # Changes whenever any role's permissions do (part of the users' ETags)
+        self.fingerprint = 0
+        self.loaded = False
+        self.loaded_at = 0.0
+        self._generation = 0
+        self._load_lock = asyncio.Lock()
+
+    def build(self, permissions: Iterable[Tuple[int, str]], grants: Iterable[Tuple[int, int]]):
+        bits = {name: permission_id for permission_id, name in permissions}
+        role_masks: Dict[int, int] = {}
+        for role_id, permission_id in grants:
+            role_masks[role_id] = role_masks.get(role_id, 0) | (1 << permission_id)
+        self.fingerprint = zlib.crc32(repr(sorted(role_masks.items())).encode())
+        self.bits, self.role_masks, self.loaded = bits, role_masks, True
+        self.loaded_at = time.monotonic()
+
+    def is_current(self) -> bool:
+        return self.loaded and time.monotonic() - self.loaded_at < PERMISSION_REGISTRY_TTL
+
+    async def ensure_loaded(self):
+        if self.is_current():
+            return
+        async with self._load_lock:
+            if self.is_current():
+                return
+            generation = self._generation
+            async with database.AsyncSessionLocal() as db:
+                permissions = (await db.execute(select(models.Permission.id, models.Permission.name))).all()
+                grants = (await db.execute(
+                    select(models.role_permission.c.role_id, models.role_permission.c.permission_id)
+                )).all()
+            self.build(permissions, grants)
+            # A write while we were reading - load again on next use
+            if generation != self._generation:
+                self.loaded = False
+
+    def invalidate(self):
+        self._generation += 1
+        self.loaded = False
+
+    async def role_mask(self, role_id: Optional[int]) -> int:
+        await self.ensure_loaded()
+        return self.role_masks.get(role_id, 0)
+
+    async def get_fingerprint(self) -> int:
+        await self.ensure_loaded()
+        return self.fingerprint
+
+    async def bit(self, name: str) -> Optional[int]:
+        await self.ensure_loaded()
+        return self.bits.get(name)
+
+
+def has_permission(mask: int, bit: Optional[int]) -> bool:
+    return bit is not None and bool((mask >> bit) & 1)
+
+
+registry = PermissionRegistry()
@@ -0,0 +1,133 @@
+"""
+Connection pool instrumentation.
+
+The pool classes below time every checkout (the wait for a free connection,
+including pre-ping) and the pool event listeners count connects, checkouts,
+checkins and invalidations, so /api/admin/pool can show when a burst is
+exhausting the pool.
+"""
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Upper bounds of the wait-time histogram buckets, in milliseconds
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class PoolMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.wait_counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.timeouts = 0
+
+    def observe_wait(self, elapsed_ms: float):
+        index = len(WAIT_BUCKETS_MS)
+        for i, bound in enumerate(WAIT_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                index = i
+                break
+        with self._lock:
+            self.wait_counts[index] += 1
+            self.wait_total_ms += elapsed_ms
+            if elapsed_ms > self.wait_max_ms:
+                self.wait_max_ms = elapsed_ms
+
+    def incr(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self, pool) -> dict:
+        with self._lock:
+            counts = list(self.wait_counts)
+            total = sum(counts)
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(WAIT_BUCKETS_MS + ("+Inf",), counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            stats = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "wait_ms": {
+                    "count": total,
+                    "sum": round(self.wait_total_ms, 3),
+                    "max": round(self.wait_max_ms, 3),
+                    "buckets": buckets,
+                },
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+            })
+        return {"name": self.name, **stats}
+
+
+class _TimedPoolMixin:
+    metrics: PoolMetrics = None
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.incr("timeouts")
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_wait((time.perf_counter() - start) * 1000)
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool - keep reporting into the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument(engine, name: str) -> PoolMetrics:
+    """Attach metrics and pool event listeners to an engine's pool"""
+    metrics = PoolMetrics(name)
+    pool = engine.pool
+    if isinstance(pool, _TimedPoolMixin):
+        pool.metrics = metrics
+
+    @event.listens_for(pool, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        metrics.incr("connects")
+
+    @event.listens_for(pool, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.incr("checkouts")
+
+    @event.listens_for(pool, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        metrics.incr("checkins")
+
+    @event.listens_for(pool, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        metrics.incr("invalidations")
+
+    return metrics
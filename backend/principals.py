@@ -0,0 +1,63 @@
+"""
+Authenticated principal cache.
+
+get_current_user caches the user it built for a token. Every protected endpoint
+goes through it (auth.require_permission checks the user is still active), so
+repeat requests with the same token skip the database. Entries live for
+at most PRINCIPAL_CACHE_TTL seconds (0 disables the cache) and never past the
+token's own expiry. Changing or deactivating a user bumps that user's
+generation, which invalidates every cached token of theirs in this worker;
+other workers pick the change up within the TTL.
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from . import schemas
+from .cache import MISSING, TTLCache
+
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+
+principal_cache = TTLCache("principals", maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+_generations: Dict[str, int] = {}
+_lock = threading.Lock()
+
+
+def get_principal(token: str) -> Optional[schemas.User]:
+    if not PRINCIPAL_CACHE_TTL:
+        return None
+    entry = principal_cache.get(token)
+    if entry is MISSING:
+        return None
+    generation, user = entry
+    if _generations.get(user.email, 0) != generation:
+        principal_cache.delete(token)
+        return None
+    return user
+
+
+def get_generation(email: str) -> int:
+    """Read before loading the user, so an invalidation during the load isn't lost"""
+    return _generations.get(email, 0)
+
+
+def cache_principal(token: str, user: schemas.User, generation: int, expires_at: Optional[float] = None):
+    if not PRINCIPAL_CACHE_TTL:
+        return
+    ttl = PRINCIPAL_CACHE_TTL
+    if expires_at is not None:
+        ttl = min(ttl, expires_at - time.time())
+        if ttl <= 0:
+            return
+    principal_cache.set(token, (generation, user), ttl=ttl)
+
+
+def invalidate_user(email: Optional[str]):
+    """Drop every cached principal of this user"""
+    if email is None:
+        return
+    with _lock:
+        _generations[email] = _generations.get(email, 0) + 1
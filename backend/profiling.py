@@ -0,0 +1,164 @@
+"""
+SQL profiling.
+
+Cursor execute listeners on both engines add every statement's count and
+duration to the current request's QueryStats (held in a contextvar).
+Statements slower than SLOW_QUERY_MS go to the "backend.slow_queries" log
+with their normalised SQL and the backend call site that issued them.
+
+Profiling is per request: SQL_PROFILE_SAMPLE_RATE (0-1, default 0) picks the
+share of requests that are profiled. Outside a profiled request the listeners
+return immediately.
+
+SQL_PROFILE_DEBUG=1 (development only) also reports each profiled request's
+query count and DB time in a Server-Timing header, and lets a request carrying
+"X-SQL-Profile: 1" ask to be profiled. Without it neither is exposed to clients.
+"""
+import logging
+import os
+import random
+import re
+import sys
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+SQL_PROFILE_SAMPLE_RATE = float(os.getenv("SQL_PROFILE_SAMPLE_RATE", 0.0))
+SQL_PROFILE_DEBUG = os.getenv("SQL_PROFILE_DEBUG", "0").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG")
+PROFILE_HEADER = b"x-sql-profile"
+
+slow_query_logger = logging.getLogger("backend.slow_queries")
+if SLOW_QUERY_LOG:
+    _handler = logging.FileHandler(SLOW_QUERY_LOG)
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    slow_query_logger.addHandler(_handler)
+    slow_query_logger.setLevel(logging.WARNING)
+
+
+class QueryStats:
+    __slots__ = ("count", "duration")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+current_stats: ContextVar[Optional[QueryStats]] = ContextVar("sql_query_stats", default=None)
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+_THIS_FILE = os.path.abspath(__file__)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*(?:\?|%\([^)]*\)s|\$\d+|:\w+)(?:\s*,\s*(?:\?|%\([^)]*\)s|\$\d+|:\w+))+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(statement: str) -> str:
+    """Collapse literals, bind lists and whitespace so equal queries group together"""
+    sql = _STRING_LITERAL.sub("?", statement)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _IN_LIST.sub("(?)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def _find_call_site(frame) -> Optional[str]:
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(_BACKEND_DIR) and filename != _THIS_FILE:
+            return f"{os.path.relpath(filename, os.path.dirname(_BACKEND_DIR))}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+def call_site() -> str:
+    """First backend frame that led to the query (skips SQLAlchemy and this module)"""
+    site = _find_call_site(sys._getframe(1))
+    # AsyncSession runs the query in a greenlet; the caller is on the parent's stack
+    if site is None and greenlet is not None:
+        parent = greenlet.getcurrent().parent
+        if parent is not None:
+            site = _find_call_site(parent.gr_frame)
+    return site or "unknown"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats.get() is not None:
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats.get()
+    if stats is None:
+        return
+    starts = conn.info.get("query_start_time")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    stats.count += 1
+    stats.duration += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_query_logger.warning(
+            "slow query %.1fms at %s: %s", elapsed * 1000, call_site(), normalize_sql(statement)
+        )
+
+
+def _handle_error(exception_context):
+    # Failed statements never reach after_cursor_execute - drop their start time
+    connection = exception_context.connection
+    if connection is not None and current_stats.get() is not None:
+        starts = connection.info.get("query_start_time")
+        if starts:
+            starts.pop()
+
+
+def attach(engine):
+    """Install the profiling listeners on a (sync) engine"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def _should_profile(scope) -> bool:
+    if SQL_PROFILE_DEBUG:
+        for name, value in scope.get("headers", ()):
+            if name == PROFILE_HEADER:
+                return value not in (b"0", b"false")
+    return SQL_PROFILE_SAMPLE_RATE >= 1 or random.random() < SQL_PROFILE_SAMPLE_RATE
+
+
+class SQLProfilingMiddleware:
+    """Profiles sampled requests; with SQL_PROFILE_DEBUG adds `Server-Timing: db;dur=<ms>;desc="<n> queries"`"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = current_stats.set(stats)
+
+        async def send_wrapper(message):
+            if SQL_PROFILE_DEBUG and message["type"] == "http.response.start":
+                timing = f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"'
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", timing.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_stats.reset(token)
@@ -0,0 +1,201 @@
+"""
+Projection-based serialization for the list endpoints.
+
+Loading ORM entities and validating each one against schemas.User /
+schemas.Item (from_attributes) is most of the CPU time of a large page.
+read_users / read_items instead select only the requested columns as row
+tuples, attach items and roles with one query each, and render the page in
+one pass with orjson (plain json when orjson is not installed).
+
+`fields` is a comma separated sparse fieldset - by default every field of the
+schema is returned, in the same shape as before. Leaving out "items" or
+"role" also skips their query.
+"""
+import json
+from datetime import date, datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, schemas
+from .export import parse_fields
+from .pagination import keyset_page, split_page
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Response fields in schema order
+USER_FIELDS = tuple(schemas.User.model_fields)
+ITEM_FIELDS = tuple(schemas.Item.model_fields)
+ROLE_FIELDS = tuple(f for f in schemas.Role.model_fields if f != "permissions")
+PERMISSION_FIELDS = tuple(schemas.Permission.model_fields)
+
+USER_RELATIONS = ("items", "role")
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def _columns(model, fields: Sequence[str], required: Sequence[str]):
+    """The selected fields' columns, plus the ones needed for paging and joining"""
+    names = list(dict.fromkeys([*fields, *required]))
+    return names, [getattr(model, name) for name in names]
+
+
+async def _items_by_owner(db: AsyncSession, owner_ids: List[int]) -> Dict[int, list]:
+    columns = [getattr(models.Item, f) for f in ITEM_FIELDS]
+    result = await db.execute(select(*columns).where(models.Item.owner_id.in_(owner_ids)))
+    owner_index = ITEM_FIELDS.index("owner_id")
+    items: Dict[int, list] = {owner_id: [] for owner_id in owner_ids}
+    for row in result:
+        items[row[owner_index]].append(dict(zip(ITEM_FIELDS, row)))
+    return items
+
+
+async def _roles_by_id(db: AsyncSession, role_ids: List[int]) -> Dict[int, dict]:
+    """Roles with their permissions, in a single outer-joined query"""
+    role_columns = [getattr(models.Role, f) for f in ROLE_FIELDS]
+    permission_columns = [getattr(models.Permission, f) for f in PERMISSION_FIELDS]
+    result = await db.execute(
+        select(models.Role.id, *role_columns, models.Permission.id, *permission_columns)
+        .select_from(models.Role)
+        .outerjoin(models.role_permission, models.role_permission.c.role_id == models.Role.id)
+        .outerjoin(models.Permission, models.Permission.id == models.role_permission.c.permission_id)
+        .where(models.Role.id.in_(role_ids))
+    )
+    split = 1 + len(ROLE_FIELDS)
+    roles: Dict[int, dict] = {}
+    for row in result:
+        role = roles.get(row[0])
+        if role is None:
+            role = roles[row[0]] = {**dict(zip(ROLE_FIELDS, row[1:split])), "permissions": []}
+        if row[split] is not None:
+            role["permissions"].append(dict(zip(PERMISSION_FIELDS, row[split + 1:])))
+    return roles
+
+
+async def _user_dicts(db: AsyncSession, rows, names: List[str], selected: List[str]) -> List[dict]:
+    scalars = [(f, names.index(f)) for f in selected if f not in USER_RELATIONS]
+    id_index, role_index = names.index("id"), names.index("role_id")
+    with_items, with_role = "items" in selected, "role" in selected
+
+    items: Dict[int, list] = {}
+    if with_items and rows:
+        items = await _items_by_owner(db, [row[id_index] for row in rows])
+    roles: Dict[int, dict] = {}
+    if with_role and rows:
+        role_ids = {row[role_index] for row in rows if row[role_index] is not None}
+        if role_ids:
+            roles = await _roles_by_id(db, list(role_ids))
+
+    users = []
+    for row in rows:
+        user = {f: row[i] for f, i in scalars}
+        if with_items:
+            user["items"] = items[row[id_index]]
+        if with_role:
+            user["role"] = roles.get(row[role_index])
+        users.append(user)
+    return users
+
+
+def _page(stmt, model, skip: int, limit: int, cursor: Optional[str], order_by: str, sort_keys: Sequence[str]):
+    if cursor is None:
+        # Ordered, so the validator's aggregate and the row query pick the same rows
+        return stmt.order_by(model.id).offset(skip).limit(limit)
+    return keyset_page(stmt, model, sort_keys, order_by, cursor, limit)
+
+
+def _validator(rows, id_index: int, version_index: int) -> Tuple[int, int, int]:
+    """(count, max(version), sum(id)) of the fetched rows - see backend/etags.py"""
+    return (
+        len(rows),
+        max((row[version_index] for row in rows), default=0),
+        sum(row[id_index] for row in rows),
+    )
+
+
+async def page_validator(
+    db: AsyncSession,
+    model,
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+    order_by: str,
+    sort_keys: Sequence[str],
+) -> Tuple[int, int, int]:
+    """The page's validator from one aggregate query, without fetching its rows"""
+    page = _page(select(model.id, model.version), model, skip, limit, cursor, order_by, sort_keys).subquery()
+    row = (await db.execute(
+        select(func.count(page.c.id), func.max(page.c.version), func.sum(page.c.id))
+    )).one()
+    return row[0], row[1] or 0, row[2] or 0
+
+
+async def read_users(
+    db: AsyncSession,
+    fields: Optional[str],
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+    order_by: str,
+    sort_keys: Sequence[str],
+):
+    """The users page as plain dicts - a list, or {items, next_cursor} with a cursor - and its validator"""
+    selected = parse_fields(fields, USER_FIELDS)
+    columns_wanted = [f for f in selected if f not in USER_RELATIONS]
+    required = ["id", "role_id", "version"] + ([order_by] if cursor is not None and order_by in sort_keys else [])
+    names, columns = _columns(models.User, columns_wanted, required)
+    rows = (await db.execute(
+        _page(select(*columns), models.User, skip, limit, cursor, order_by, sort_keys)
+    )).all()
+    validator = _validator(rows, names.index("id"), names.index("version"))
+    if cursor is None:
+        return await _user_dicts(db, rows, names, selected), validator
+    rows, next_cursor = split_page(rows, order_by, limit)
+    return {"items": await _user_dicts(db, rows, names, selected), "next_cursor": next_cursor}, validator
+
+
+async def read_items(
+    db: AsyncSession,
+    fields: Optional[str],
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+    order_by: str,
+    sort_keys: Sequence[str],
+):
+    """The items page as plain dicts - a list, or {items, next_cursor} with a cursor - and its validator"""
+    selected = parse_fields(fields, ITEM_FIELDS)
+    required = ["id", "version"] + ([order_by] if cursor is not None and order_by in sort_keys else [])
+    names, columns = _columns(models.Item, selected, required)
+    rows = (await db.execute(
+        _page(select(*columns), models.Item, skip, limit, cursor, order_by, sort_keys)
+    )).all()
+    validator = _validator(rows, names.index("id"), names.index("version"))
+    next_cursor = None
+    if cursor is not None:
+        rows, next_cursor = split_page(rows, order_by, limit)
+    positions = [names.index(f) for f in selected]
+    items = [{f: row[i] for f, i in zip(selected, positions)} for row in rows]
+    if cursor is None:
+        return items, validator
+    return {"items": items, "next_cursor": next_cursor}, validator
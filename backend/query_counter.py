@@ -0,0 +1,55 @@
+"""
+Query counting helpers for N+1 checks.
+
+    with assert_max_queries(engine, 3):
+        client.get("/api/users/?limit=100")
+
+Works with both the sync engine and the async engine (its sync_engine is used).
+"""
+from contextlib import contextmanager
+from typing import List
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements: List[str] = []
+        # (statement, parameters) - e.g. to EXPLAIN them afterwards
+        self.executions: List[tuple] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+        self.executions.append((statement, parameters))
+
+
+def _sync_engine(engine):
+    return getattr(engine, "sync_engine", engine)
+
+
+@contextmanager
+def count_queries(engine):
+    """Count the SQL statements executed on `engine` inside the block"""
+    counter = QueryCounter()
+    target = _sync_engine(engine)
+    event.listen(target, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(target, "before_cursor_execute", counter)
+
+
+@contextmanager
+def assert_max_queries(engine, expected: int):
+    """Fail if the block runs more than `expected` SQL statements"""
+    with count_queries(engine) as counter:
+        yield counter
+    if counter.count > expected:
+        statements = "\n".join(f"  {i + 1}. {sql}" for i, sql in enumerate(counter.statements))
+        raise AssertionError(
+            f"Expected at most {expected} queries, got {counter.count}:\n{statements}"
+        )
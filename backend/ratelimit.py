@@ -0,0 +1,219 @@
+"""
+Login throttling with token buckets.
+
+Every /api/auth/login attempt takes a token from its client IP's bucket, and
+every failed one a token from the account's (email's) bucket. A bucket holds
+up to N tokens and refills at N per S seconds (LOGIN_RATE_PER_IP /
+LOGIN_RATE_PER_ACCOUNT as "N/S"; "0" turns a limit off). When either bucket
+is empty the login is refused with 429 and Retry-After before the user is
+looked up or a password is hashed, so a credential-stuffing burst can't use
+up the bcrypt workers.
+Charging the account only on failure keeps an attacker who guesses wrong from
+spending the tokens of a user who types the right password.
+
+Stores:
+  - memory (default): per worker, sharded into SHARDS dicts with a lock each,
+    so concurrent threads rarely wait on each other. Each shard keeps at most
+    RATE_LIMIT_SIZE / SHARDS buckets (least recently used are dropped).
+  - RATE_LIMIT_URL=redis://...: buckets shared by all workers, updated
+    atomically by a Lua script - one round-trip per check. Needs `redis`.
+
+With the memory store each worker enforces the limits on its own, so the
+server as a whole allows up to workers x N attempts. If the shared store
+can't be reached, logins are allowed (and counted in the stats).
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.security import OAuth2PasswordRequestForm
+
+try:
+    from config import LOGIN_RATE_PER_IP, LOGIN_RATE_PER_ACCOUNT, RATE_LIMIT_URL
+except ImportError:
+    LOGIN_RATE_PER_IP, LOGIN_RATE_PER_ACCOUNT, RATE_LIMIT_URL = "20/60", "5/300", None
+
+LOGIN_RATE_PER_IP = os.getenv("LOGIN_RATE_PER_IP", LOGIN_RATE_PER_IP)
+LOGIN_RATE_PER_ACCOUNT = os.getenv("LOGIN_RATE_PER_ACCOUNT", LOGIN_RATE_PER_ACCOUNT)
+RATE_LIMIT_URL = os.getenv("RATE_LIMIT_URL", RATE_LIMIT_URL)
+RATE_LIMIT_SIZE = int(os.getenv("RATE_LIMIT_SIZE", 100000))
+
+SHARDS = 64
+KEY_PREFIX = "capsule:rl:"
+
+
+class Rate(NamedTuple):
+    capacity: float
+    per_second: float
+
+    @classmethod
+    def parse(cls, value: Optional[str]) -> Optional["Rate"]:
+        """ "N/S" - N attempts, refilled over S seconds; "0" (or empty) means no limit"""
+        count, _, seconds = (value or "0").partition("/")
+        if not float(count):
+            return None
+        return cls(float(count), float(count) / float(seconds or 1))
+
+
+def _refill(tokens: float, updated: float, rate: Rate, now: float) -> float:
+    return min(rate.capacity, tokens + max(0.0, now - updated) * rate.per_second)
+
+
+class MemoryStore:
+    name = "memory"
+
+    def __init__(self, maxsize: int, shards: int = SHARDS):
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+        self._shard_size = max(1, maxsize // shards)
+
+    async def hit(self, key: str, rate: Rate, cost: int) -> float:
+        return self.hit_sync(key, rate, cost)
+
+    def hit_sync(self, key: str, rate: Rate, cost: int) -> float:
+        """Take `cost` tokens (0 only checks) - returns 0, or the seconds until a token is available"""
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with lock:
+            tokens, updated = buckets.get(key, (rate.capacity, now))
+            tokens = _refill(tokens, updated, rate, now)
+            needed = max(cost, 1)
+            retry_after = 0.0
+            if tokens < needed:
+                retry_after = (needed - tokens) / rate.per_second
+            else:
+                tokens -= cost
+            buckets[key] = (tokens, now)
+            buckets.move_to_end(key)
+            if len(buckets) > self._shard_size:
+                buckets.popitem(last=False)
+        return retry_after
+
+    def size(self) -> int:
+        return sum(len(buckets) for _, buckets in self._shards)
+
+
+# KEYS[1] bucket; ARGV capacity, refill per second, cost, now (seconds)
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local needed = math.max(cost, 1)
+local retry_after = 0
+if tokens < needed then
+    retry_after = (needed - tokens) / rate
+else
+    tokens = tokens - cost
+end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'ts', tostring(now))
+-- Gone once it would be full again
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+class RedisStore:
+    name = "redis"
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_URL needs the redis package: pip install redis")
+        self.client = redis.asyncio.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def hit(self, key: str, rate: Rate, cost: int) -> float:
+        # Wall clock - the workers (and hosts) sharing the buckets agree on it, unlike monotonic time
+        retry_after = await self.script(
+            keys=[KEY_PREFIX + key], args=[rate.capacity, rate.per_second, cost, time.time()]
+        )
+        return float(retry_after)
+
+
+class RateLimiter:
+    def __init__(self, url: Optional[str], maxsize: int):
+        self.url = url
+        self.maxsize = maxsize
+        self._store = None
+        self.allowed = 0
+        self.limited = 0
+        self.errors = 0
+
+    @property
+    def store(self):
+        # Created on first use - importing the app must not connect anywhere
+        if self._store is None:
+            self._store = RedisStore(self.url) if self.url else MemoryStore(self.maxsize)
+        return self._store
+
+    async def hit(self, key: str, rate: Rate, cost: int = 1) -> float:
+        try:
+            return await self.store.hit(key, rate, cost)
+        except Exception:
+            # Fail open - a broken shared store must not lock everybody out
+            self.errors += 1
+            return 0.0
+
+    def stats(self) -> dict:
+        stats = {
+            "name": "login_throttle",
+            "backend": self.store.name,
+            "per_ip": LOGIN_RATE_PER_IP,
+            "per_account": LOGIN_RATE_PER_ACCOUNT,
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "errors": self.errors,
+        }
+        if isinstance(self.store, MemoryStore):
+            stats["size"] = self.store.size()
+        return stats
+
+
+limiter = RateLimiter(RATE_LIMIT_URL, RATE_LIMIT_SIZE)
+ip_rate = Rate.parse(LOGIN_RATE_PER_IP)
+account_rate = Rate.parse(LOGIN_RATE_PER_ACCOUNT)
+
+
+def too_many_attempts(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="יותר מדי ניסיונות התחברות, נסה שוב מאוחר יותר",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class LoginAttempt:
+    """Handed to the login route - call failed() when the credentials are wrong"""
+
+    def __init__(self, account_key: str):
+        self.account_key = account_key
+
+    async def failed(self):
+        if account_rate:
+            await limiter.hit(self.account_key, account_rate)
+
+
+async def throttle_login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()) -> LoginAttempt:
+    """Login dependency - 429 for an exhausted IP or account bucket, before any DB or bcrypt work"""
+    client_ip = request.client.host if request.client else "unknown"
+    account_key = "account:" + form_data.username.strip().lower()
+    retry_after = 0.0
+    if ip_rate:
+        retry_after = await limiter.hit("ip:" + client_ip, ip_rate)
+    if account_rate:
+        # Only checked here - a token is taken when the password turns out wrong
+        retry_after = max(retry_after, await limiter.hit(account_key, account_rate, cost=0))
+    if retry_after:
+        limiter.limited += 1
+        raise too_many_attempts(retry_after)
+    limiter.allowed += 1
+    return LoginAttempt(account_key)
@@ -0,0 +1,161 @@
+"""
+Read replica routing.
+
+DATABASE_REPLICA_URLS (or DB_REPLICA_URLS in config.py) adds read-only copies
+of the primary. Safe reads - the user/item lists and detail, the login lookup
+and the exports - take their session from get_read_db / open_read_session,
+which hand out the replicas round-robin. Writes keep using get_async_db, i.e.
+the primary. Without replicas every read uses the primary.
+
+Read-your-writes: when a request commits on the primary, ReplicaStickinessMiddleware
+adds a short-lived cookie (DB_REPLICA_STICKY_SECONDS, which should cover the
+replication lag). While a client sends it, its reads go to the primary, so a
+citizen who just registered or added an item sees it on the next GET.
+
+A replica that fails to hand out a connection is skipped for
+DB_REPLICA_RETRY_AFTER seconds; the read moves on to the next replica and,
+when none is left, to the primary.
+"""
+import itertools
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from fastapi import Request
+from sqlalchemy import event, exc
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import database
+
+try:
+    from config import DB_REPLICA_STICKY_SECONDS, DB_REPLICA_RETRY_AFTER
+except ImportError:
+    DB_REPLICA_STICKY_SECONDS, DB_REPLICA_RETRY_AFTER = 5, 30
+
+DB_REPLICA_STICKY_SECONDS = float(os.getenv("DB_REPLICA_STICKY_SECONDS", DB_REPLICA_STICKY_SECONDS))
+DB_REPLICA_RETRY_AFTER = float(os.getenv("DB_REPLICA_RETRY_AFTER", DB_REPLICA_RETRY_AFTER))
+
+STICKY_COOKIE = "db_primary_until"
+
+# Errors that mean "this replica can't serve us right now"
+REPLICA_ERRORS = (exc.DBAPIError, exc.TimeoutError, OSError)
+
+_next_replica = itertools.count()
+# replica index -> time.monotonic() before which it is skipped
+_down_until: Dict[int, float] = {}
+_lock = threading.Lock()
+
+
+class RequestWrites:
+    __slots__ = ("committed",)
+
+    def __init__(self):
+        self.committed = False
+
+
+# Mutable holder - set by the middleware, flagged from inside the session's greenlet
+current_writes: ContextVar[Optional[RequestWrites]] = ContextVar("request_writes", default=None)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    # Read sessions never commit, so any commit inside a request is a write on the primary
+    writes = current_writes.get()
+    if writes is not None:
+        writes.committed = True
+
+
+def mark_down(index: int):
+    with _lock:
+        if _down_until.get(index, 0) <= time.monotonic():
+            print(f"❌ Read replica {index} unavailable - skipping it for {DB_REPLICA_RETRY_AFTER:g}s")
+        _down_until[index] = time.monotonic() + DB_REPLICA_RETRY_AFTER
+
+
+def replica_order():
+    """Replica indexes to try, starting at the next one in round-robin order, skipping failed ones"""
+    count = len(database.SQLALCHEMY_ASYNC_REPLICA_URLS)
+    if not count:
+        return []
+    start = next(_next_replica) % count
+    now = time.monotonic()
+    return [i for i in ((start + n) % count for n in range(count)) if _down_until.get(i, 0) <= now]
+
+
+def get_status() -> list:
+    now = time.monotonic()
+    return [
+        {"replica": i, "available": _down_until.get(i, 0) <= now}
+        for i in range(len(database.SQLALCHEMY_ASYNC_REPLICA_URLS))
+    ]
+
+
+async def open_read_session(primary: bool = False) -> AsyncSession:
+    """A session for safe reads: the next healthy replica, or the primary"""
+    database.init_engines()
+    if not primary:
+        for index in replica_order():
+            session = database.ReplicaSessionLocals[index]()
+            try:
+                # Check out the connection now, so a dead replica is noticed before the query
+                await session.connection()
+                return session
+            except REPLICA_ERRORS:
+                await session.close()
+                mark_down(index)
+    return database.AsyncSessionLocal()
+
+
+def is_sticky(request: Request) -> bool:
+    value = request.cookies.get(STICKY_COOKIE)
+    if not value:
+        return False
+    try:
+        return float(value) > time.time()
+    except ValueError:
+        return False
+
+
+async def read_session(request: Request) -> AsyncSession:
+    """open_read_session() honouring the client's read-your-writes cookie"""
+    return await open_read_session(primary=is_sticky(request))
+
+
+async def get_read_db(request: Request):
+    """Dependency for read-only endpoints (writes must use get_async_db)"""
+    session = await read_session(request)
+    async with session:
+        yield session
+
+
+class ReplicaStickinessMiddleware:
+    """Adds the read-your-writes cookie to responses of requests that committed on the primary"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not database.DB_REPLICA_URLS:
+            await self.app(scope, receive, send)
+            return
+
+        writes = RequestWrites()
+        token = current_writes.set(writes)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and writes.committed:
+                until = time.time() + DB_REPLICA_STICKY_SECONDS
+                cookie = (f"{STICKY_COOKIE}={until:.3f}; Max-Age={int(DB_REPLICA_STICKY_SECONDS) or 1}; "
+                          "Path=/; HttpOnly; SameSite=Lax")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"set-cookie", cookie.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_writes.reset(token)
@@ -0,0 +1,259 @@
+"""
+Response cache for hot read endpoints.
+
+GET /api/users/{user_id} and GET /api/items/ keep their rendered JSON body
+and ETag here, keyed by route, path and query parameters. Every route
+belongs to a namespace with its own TTL (RESPONSE_CACHE_TTLS, 0 disables
+it), and the crud write functions invalidate whole namespaces by bumping the
+namespace's generation; entries written under an older generation are
+ignored.
+
+Backends:
+  - "memory" (default): a per-worker LRU (cache.TTLCache). Invalidations are
+    local, so other workers may serve an entry until its TTL runs out.
+  - RESPONSE_CACHE_URL=redis://...: any Redis-protocol server, shared by all
+    workers, so invalidations are seen everywhere. Needs the `redis` package.
+    A lookup is one MGET of the entry and its namespace generation.
+
+Stampedes: concurrent misses for a key in a worker wait for a single
+computation, and hot entries are refreshed early with a probability that
+rises as they approach expiry (probabilistic early expiration, "XFetch"),
+so workers don't all recompute at the moment an entry expires.
+
+Cache errors never fail a request - the response is computed directly.
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+from fastapi import Request
+
+from .cache import MISSING, TTLCache
+
+try:
+    from config import RESPONSE_CACHE_URL, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_SIZE
+except ImportError:
+    RESPONSE_CACHE_URL, RESPONSE_CACHE_SIZE = None, 10000
+    RESPONSE_CACHE_TTLS = {"users": 30, "items": 10}
+
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", RESPONSE_CACHE_URL)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", RESPONSE_CACHE_SIZE))
+# e.g. RESPONSE_CACHE_TTLS="users=30,items=10"
+if os.getenv("RESPONSE_CACHE_TTLS"):
+    RESPONSE_CACHE_TTLS = {
+        name.strip(): float(ttl)
+        for name, ttl in (pair.split("=") for pair in os.getenv("RESPONSE_CACHE_TTLS").split(",") if pair.strip())
+    }
+# Higher refreshes hot entries earlier (1.0 is the usual XFetch setting)
+RESPONSE_CACHE_EARLY_REFRESH = float(os.getenv("RESPONSE_CACHE_EARLY_REFRESH", 1.0))
+
+KEY_PREFIX = "capsule:rc:"
+
+
+class Entry(NamedTuple):
+    body: bytes
+    etag: str
+    generation: int
+    # Seconds the computation took and when (wall clock) the entry expires - for early refresh
+    delta: float
+    expires_at: float
+
+
+class MemoryBackend:
+    name = "memory"
+
+    def __init__(self, maxsize: int):
+        self.entries = TTLCache("responses", maxsize=maxsize)
+        self.generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    async def lookup(self, namespace: str, key: str):
+        entry = self.entries.get(key)
+        return (None if entry is MISSING else entry), self.generations.get(namespace, 0)
+
+    async def store(self, key: str, entry: Entry, ttl: float):
+        self.entries.set(key, entry, ttl=ttl)
+
+    def bump(self, namespace: str):
+        with self._lock:
+            self.generations[namespace] = self.generations.get(namespace, 0) + 1
+
+    async def abump(self, namespace: str):
+        self.bump(namespace)
+
+
+class RedisBackend:
+    name = "redis"
+
+    def __init__(self, url: str):
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_URL needs the redis package: pip install redis")
+        self.client = redis.asyncio.Redis.from_url(url)
+        # Sync writes (scripts, threadpool routes) invalidate through a blocking client
+        self.sync_client = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _generation_key(namespace: str) -> str:
+        return f"{KEY_PREFIX}gen:{namespace}"
+
+    @staticmethod
+    def _encode(entry: Entry) -> bytes:
+        header = json.dumps([entry.etag, entry.generation, entry.delta, entry.expires_at])
+        return header.encode() + b"\n" + entry.body
+
+    @staticmethod
+    def _decode(raw: bytes) -> Entry:
+        header, _, body = raw.partition(b"\n")
+        etag, generation, delta, expires_at = json.loads(header)
+        return Entry(body, etag, generation, delta, expires_at)
+
+    async def lookup(self, namespace: str, key: str):
+        raw, generation = await self.client.mget(KEY_PREFIX + key, self._generation_key(namespace))
+        return (self._decode(raw) if raw else None), int(generation or 0)
+
+    async def store(self, key: str, entry: Entry, ttl: float):
+        await self.client.set(KEY_PREFIX + key, self._encode(entry), px=max(1, int(ttl * 1000)))
+
+    def bump(self, namespace: str):
+        self.sync_client.incr(self._generation_key(namespace))
+
+    async def abump(self, namespace: str):
+        await self.client.incr(self._generation_key(namespace))
+
+
+class ResponseCache:
+    def __init__(self, url: Optional[str], ttls: Dict[str, float], maxsize: int):
+        self.url = url
+        self.ttls = ttls
+        self.maxsize = maxsize
+        self._backend = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.early_refreshes = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    @property
+    def backend(self):
+        # Created on first use - importing the app must not connect anywhere
+        if self._backend is None:
+            self._backend = RedisBackend(self.url) if self.url else MemoryBackend(self.maxsize)
+        return self._backend
+
+    def enabled(self, namespace: str) -> bool:
+        return bool(self.ttls.get(namespace))
+
+    @staticmethod
+    def make_key(namespace: str, request: Request) -> str:
+        params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+        return f"{namespace}:{request.url.path}?{params}"
+
+    def _fresh(self, entry: Optional[Entry], generation: int) -> bool:
+        if entry is None or entry.generation != generation:
+            return False
+        now = time.time()
+        if now >= entry.expires_at:
+            return False
+        # XFetch: recompute early with a probability that grows near expiry and with the compute cost
+        if entry.delta and now - entry.delta * RESPONSE_CACHE_EARLY_REFRESH * math.log(random.random() or 1e-12) >= entry.expires_at:
+            self.early_refreshes += 1
+            return False
+        return True
+
+    async def get_or_compute(
+        self,
+        namespace: str,
+        request: Request,
+        compute: Callable[[], Awaitable[tuple]],
+    ) -> Entry:
+        """The cached (body, etag) for this request, computing it with `compute()` on a miss.
+
+        `compute` returns (body bytes, etag) and may raise (e.g. HTTPException) - errors are not cached.
+        """
+        ttl = self.ttls.get(namespace)
+        if not ttl:
+            body, etag = await compute()
+            return Entry(body, etag, 0, 0.0, 0.0)
+
+        key = self.make_key(namespace, request)
+        generation = 0
+        try:
+            entry, generation = await self.backend.lookup(namespace, key)
+        except Exception:
+            self.errors += 1
+            entry = None
+        if self._fresh(entry, generation):
+            self.hits += 1
+            return entry
+
+        # Single flight: the first miss computes, concurrent ones wait for its result
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            started = time.perf_counter()
+            body, etag = await compute()
+            delta = time.perf_counter() - started
+            entry = Entry(body, etag, generation, delta, time.time() + ttl)
+            try:
+                await self.backend.store(key, entry, ttl)
+            except Exception:
+                self.errors += 1
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody else may be waiting - don't let asyncio warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def invalidate(self, *namespaces: str):
+        """For sync code (crud's Session functions)"""
+        for namespace in namespaces:
+            try:
+                self.backend.bump(namespace)
+            except Exception:
+                self.errors += 1
+
+    async def ainvalidate(self, *namespaces: str):
+        for namespace in namespaces:
+            try:
+                await self.backend.abump(namespace)
+            except Exception:
+                self.errors += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        stats = {
+            "name": "responses",
+            "backend": self.backend.name,
+            "ttls": self.ttls,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+            "early_refreshes": self.early_refreshes,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }
+        if isinstance(self.backend, MemoryBackend):
+            stats["size"] = self.backend.entries.stats()["size"]
+        return stats
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_URL, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_SIZE)
@@ -0,0 +1,109 @@
+"""
+Capsule status rollup.
+
+models.CapsuleStatusCount holds the number of citizens per (city,
+neighborhood, capsule_status), so the operations dashboard reads a few
+hundred summary rows instead of grouping the whole users table.
+
+The counts are kept up to date incrementally, in the same transaction as the
+write: registration (crud.create_user / create_user_async), the bulk import
+and profile updates that change the address or status (crud.update_user /
+update_user_async) each apply their +1 / -1 deltas with one upsert statement.
+
+The upsert locks the rows it changes until the transaction commits. Most
+registrations share one key ("", "", "not_ready" - the form has no address),
+so every key is spread over ROLLUP_SHARDS rows: each write adds its deltas to
+a randomly chosen shard and read_counts() sums them. Concurrent registrations
+then mostly lock different rows instead of queueing on one.
+Writes that bypass crud (manual SQL, restoring a dump) are not seen - run
+rebuild_capsule_rollups.py to recompute the table from users.
+"""
+import os
+import random
+from collections import Counter
+from typing import Mapping, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import models
+
+Key = Tuple[str, str, str]
+
+KEY_FIELDS = ("city", "neighborhood", "capsule_status")
+
+# Rows each key's count is spread over - about the number of writers expected at once
+ROLLUP_SHARDS = int(os.getenv("ROLLUP_SHARDS", 16))
+
+
+def user_key(values) -> Key:
+    """The rollup key of a user - a models.User or a dict of its column values"""
+    get = values.get if isinstance(values, Mapping) else lambda name: getattr(values, name)
+    return tuple(get(name) or "" for name in KEY_FIELDS)
+
+
+def moved(old: Key, new: Key) -> Counter:
+    if old == new:
+        return Counter()
+    return Counter({old: -1, new: 1})
+
+
+def _upsert(dialect_name: str, deltas: Counter):
+    """One INSERT ... ON CONFLICT DO UPDATE adding every delta to its row in a random shard"""
+    insert_ = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+    table = models.CapsuleStatusCount
+    shard = random.randrange(ROLLUP_SHARDS)
+    stmt = insert_(table).values([
+        {**dict(zip(KEY_FIELDS, key)), "shard": shard, "count": delta}
+        # Sorted, so concurrent writers lock the rows in the same order
+        for key, delta in sorted(deltas.items()) if delta
+    ])
+    return stmt.on_conflict_do_update(
+        index_elements=[*(getattr(table, name) for name in KEY_FIELDS), table.shard],
+        set_={"count": table.count + stmt.excluded["count"]},
+    )
+
+
+def apply(db: Session, deltas: Counter):
+    """Add the deltas inside the caller's transaction (no commit)"""
+    if any(deltas.values()):
+        db.execute(_upsert(db.get_bind().dialect.name, deltas))
+
+
+async def apply_async(db: AsyncSession, deltas: Counter):
+    if any(deltas.values()):
+        await db.execute(_upsert(db.get_bind().dialect.name, deltas))
+
+
+def rebuild(db: Session) -> int:
+    """Recompute the whole table from users in one transaction (all in shard 0) - returns the number of rows"""
+    User = models.User
+    keys = [func.coalesce(getattr(User, name), "") for name in KEY_FIELDS]
+    grouped = select(*keys, func.count()).group_by(*keys)
+    db.execute(delete(models.CapsuleStatusCount))
+    db.execute(insert(models.CapsuleStatusCount).from_select([*KEY_FIELDS, "count"], grouped))
+    db.commit()
+    return db.query(models.CapsuleStatusCount).count()
+
+
+async def read_counts(db: AsyncSession, city: Optional[str] = None, neighborhood: Optional[str] = None) -> dict:
+    """Totals by status and per area, from the rollup only - its size doesn't grow with the citizens"""
+    table = models.CapsuleStatusCount
+    keys = (table.city, table.neighborhood, table.capsule_status)
+    count = func.sum(table.count)
+    stmt = select(*keys, count)
+    if city is not None:
+        stmt = stmt.where(table.city == city)
+    if neighborhood is not None:
+        stmt = stmt.where(table.neighborhood == neighborhood)
+    stmt = stmt.group_by(*keys).having(count != 0).order_by(*keys)
+
+    by_status: Counter = Counter()
+    areas = []
+    for city_, neighborhood_, status, count in await db.execute(stmt):
+        by_status[status] += count
+        areas.append({"city": city_, "neighborhood": neighborhood_, "capsule_status": status, "count": count})
+    return {"total": sum(by_status.values()), "by_status": dict(by_status), "areas": areas}
@@ -6,4 +6,8 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 if __name__ == "__main__":
-    uvicorn.run("backend.main:app", host="127.0.0.1", port=8000, reload=True) 
\ No newline at end of file
+    if "--production" in sys.argv[1:]:
+        from backend.serve import serve
+        serve()
+    else:
+        uvicorn.run("backend.main:app", host="127.0.0.1", port=8000, reload=True) 
@@ -1,6 +1,6 @@
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, EmailStr, Field, field_validator
 
 
 class PermissionBase(BaseModel):
@@ -78,6 +78,31 @@ class UserCreate(BaseModel):
     role_id: Optional[int] = None
 
 
+class UserUpdate(BaseModel):
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    city: Optional[str] = None
+    neighborhood: Optional[str] = None
+    street: Optional[str] = None
+    building: Optional[str] = None
+    entrance: Optional[str] = None
+    postal_code: Optional[str] = None
+    date_of_birth: Optional[datetime] = None
+    gender: Optional[str] = None
+    phone_number: Optional[str] = None
+    is_active: Optional[bool] = None
+    capsule_status: Optional[str] = None
+
+    # Optional means "may be left out" (only the sent fields are applied) - these
+    # columns can't hold null, so an explicit null is a 422, not an IntegrityError
+    @field_validator("first_name", "last_name", "is_active", "capsule_status")
+    @classmethod
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError("may be left out but not null")
+        return value
+
+
 class User(UserBase):
     id: int
     first_name: str
@@ -104,6 +129,16 @@ class User(UserBase):
         from_attributes = True
 
 
+class UserPage(BaseModel):
+    items: List[User]
+    next_cursor: Optional[str] = None
+
+
+class ItemPage(BaseModel):
+    items: List[Item]
+    next_cursor: Optional[str] = None
+
+
 class UserLogin(BaseModel):
     email: str
     password: str
@@ -0,0 +1,129 @@
+"""
+Citizen search by name, address and phone number.
+
+GET /api/users/search?q=... matches every word of the query as a prefix
+(type-ahead: "כה חי" finds "כהן" in "חיפה") against models.SEARCH_COLUMNS
+and returns the best matches first, `skip`/`limit` paginated.
+
+  - PostgreSQL: a pg_trgm GiST index on one lower-cased document of the
+    columns (models.search_document). A row matches when it contains every
+    word, or when the query is similar enough to a part of it
+    (word_similarity, `<%`) - which also forgives typos. Ranked by
+    word_similarity, read from the index best first (`<<->`).
+  - SQLite: the contentless users_fts FTS5 table with 2 and 3 letter prefix
+    indexes, queried with a prefix term per word and ranked by bm25, names
+    weighted above the address. No typo tolerance.
+
+Phone numbers are matched on their digits ("0501234" finds "050-1234567").
+"""
+import os
+import re
+from typing import List
+
+from sqlalchemy import Float, and_, column, func, literal, literal_column, or_, select, table
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+
+# Fields of each result (plus its "score", higher is better)
+SEARCH_FIELDS = (
+    "id", "first_name", "last_name", "email", "national_id", "city", "street", "phone_number", "capsule_status",
+)
+MAX_LIMIT = 100
+# Best matches joined to users per query. A common prefix ("ha") can match a large
+# part of the table, so the matches are ranked first and only the top
+# SEARCH_RANK_WINDOW (at least skip + limit) are kept - every page is in exact rank
+# order. What the window bounds differs: PostgreSQL reads matches from the GiST
+# index in distance order and stops at the window; SQLite's FTS5 still computes
+# bm25 for every match (from the index, without touching users) and keeps the top.
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 1000))
+# Words of a query that are used - the rest is ignored
+MAX_TERMS = 8
+
+users_fts = table("users_fts", column("rowid"))
+
+
+class InvalidSearch(ValueError):
+    pass
+
+
+def query_terms(q: str) -> List[str]:
+    terms = re.findall(r"\w+", q.lower())[:MAX_TERMS]
+    if not terms:
+        raise InvalidSearch("Search query must contain a letter or digit")
+    return terms
+
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _postgres_statement(terms: List[str], columns, skip: int, limit: int, window: int):
+    document = literal_column(models.search_document("users."))
+    query = " ".join(terms)
+    every_word = and_(*(document.like(f"%{_escape_like(term)}%", escape="\\") for term in terms))
+    # 1 - word_similarity: ordering by it before the LIMIT is a GiST index scan
+    distance = literal(query).op("<<->", return_type=Float)(document)
+    candidates = (
+        select(models.User.id)
+        .where(or_(every_word, literal(query).op("<%")(document)))
+        .order_by(distance)
+        .limit(window)
+        .subquery()
+    )
+    score = func.word_similarity(query, document)
+    return (
+        select(*columns, score.label("score"))
+        .join(candidates, models.User.id == candidates.c.id)
+        .order_by(score.desc(), models.User.id)
+        .offset(skip)
+        .limit(limit)
+    )
+
+
+def _sqlite_statement(terms: List[str], columns, skip: int, limit: int, window: int):
+    # \w+ words contain no quotes, so each can be a quoted FTS5 prefix term
+    match = " ".join(f'"{term}"*' for term in terms)
+    candidates = (
+        select(users_fts.c.rowid, literal_column("rank").label("rank"))
+        .where(literal_column("users_fts").op("MATCH")(match))
+        .order_by(literal_column("rank"))
+        .limit(window)
+        .subquery()
+    )
+    # Page the ranked candidates, then join just that page to users
+    hits = select(candidates).order_by(candidates.c.rank).offset(skip).limit(limit).subquery()
+    return (
+        select(*columns, (-hits.c.rank).label("score"))
+        .join(hits, models.User.id == hits.c.rowid)
+        .order_by(hits.c.rank, models.User.id)
+    )
+
+
+async def search_users(db: AsyncSession, q: str, skip: int = 0, limit: int = 20) -> List[dict]:
+    """Ranked matches for `q`, as dicts of SEARCH_FIELDS and score"""
+    terms = query_terms(q)
+    columns = [getattr(models.User, name) for name in SEARCH_FIELDS]
+    limit = min(limit, MAX_LIMIT)
+    window = max(SEARCH_RANK_WINDOW, skip + limit)
+    if db.get_bind().dialect.name == "postgresql":
+        stmt = _postgres_statement(terms, columns, skip, limit, window)
+    else:
+        stmt = _sqlite_statement(terms, columns, skip, limit, window)
+    result = await db.execute(stmt)
+    return [dict(zip((*SEARCH_FIELDS, "score"), row)) for row in result]
+
+
+def create_index(connection):
+    """Add the search index to an existing database (sync connection; safe to repeat)"""
+    if connection.dialect.name == "postgresql":
+        for statement in models.POSTGRES_SEARCH_DDL:
+            connection.exec_driver_sql(statement)
+        return
+    for statement in models.SQLITE_SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+    # Index the rows that existed before the triggers
+    connection.exec_driver_sql("INSERT INTO users_fts(users_fts) VALUES ('delete-all')")
+    connection.exec_driver_sql(models.SQLITE_SEARCH_FILL)
+    # Merge the index into one segment - fewer, larger doclists to read per query
+    connection.exec_driver_sql("INSERT INTO users_fts(users_fts) VALUES ('optimize')")
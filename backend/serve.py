@@ -0,0 +1,191 @@
+"""
+Production launcher.
+
+Runs backend.main:app on several worker processes: one per CPU by default,
+uvloop + httptools when they are installed, workers recycled after
+WORKER_MAX_REQUESTS (with jitter so they don't all restart at once) and given
+WORKER_GRACEFUL_TIMEOUT seconds to finish in-flight requests.
+
+DB_CONNECTION_BUDGET is the number of connections the whole server may hold.
+It is split evenly between the workers, and inside a worker between the async
+engine (every request) and the sync engine (bulk import only), so that
+workers * (pool_size + max_overflow) of both engines never exceeds the budget.
+Read replicas get the async pool size, so each replica server stays within
+the budget as well.
+
+With gunicorn installed the app is preloaded in the master and forked into
+UvicornWorkers; importing the app opens no connection (the engines are created
+in each worker's lifespan), so the fork is safe. Without gunicorn, uvicorn's
+own multi-process supervisor is used, which imports the app in every worker.
+"""
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    from config import (
+        SERVER_HOST, SERVER_PORT, SERVER_WORKERS, DB_CONNECTION_BUDGET, WORKER_MAX_REQUESTS,
+        WORKER_MAX_REQUESTS_JITTER, WORKER_TIMEOUT, WORKER_GRACEFUL_TIMEOUT, KEEPALIVE_TIMEOUT
+    )
+except ImportError:
+    SERVER_HOST, SERVER_PORT, SERVER_WORKERS, DB_CONNECTION_BUDGET = "0.0.0.0", 8000, 0, 90
+    WORKER_MAX_REQUESTS, WORKER_MAX_REQUESTS_JITTER = 10000, 1000
+    WORKER_TIMEOUT, WORKER_GRACEFUL_TIMEOUT, KEEPALIVE_TIMEOUT = 60, 30, 5
+
+APP = "backend.main:app"
+
+# Connections each worker keeps for the sync engine (bulk import runs one session at a time)
+SYNC_POOL_SIZE = 1
+
+
+@dataclass
+class PoolPlan:
+    workers: int
+    per_worker: int
+    pool_size: int
+    max_overflow: int
+    sync_pool_size: int
+    sync_max_overflow: int
+
+    @property
+    def total(self) -> int:
+        """Connections the server can open at most"""
+        return self.workers * (self.pool_size + self.max_overflow + self.sync_pool_size + self.sync_max_overflow)
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def plan_pools(budget: int, workers: int) -> PoolPlan:
+    """Split a server-wide connection budget into per-worker pool settings"""
+    if workers < 1:
+        raise ValueError("At least one worker is required")
+    per_worker = budget // workers
+    if per_worker < SYNC_POOL_SIZE + 1:
+        raise ValueError(
+            f"A connection budget of {budget} is too small for {workers} workers "
+            f"(each needs at least {SYNC_POOL_SIZE + 1}); lower SERVER_WORKERS or raise DB_CONNECTION_BUDGET"
+        )
+    async_connections = per_worker - SYNC_POOL_SIZE
+    # Half kept open, half as burst overflow that is closed again when returned
+    pool_size = max(1, (async_connections + 1) // 2)
+    return PoolPlan(
+        workers=workers,
+        per_worker=per_worker,
+        pool_size=pool_size,
+        max_overflow=async_connections - pool_size,
+        sync_pool_size=SYNC_POOL_SIZE,
+        sync_max_overflow=0,
+    )
+
+
+def pick_loop() -> str:
+    try:
+        import uvloop  # noqa: F401
+        return "uvloop"
+    except ImportError:
+        return "asyncio"
+
+
+def pick_http() -> str:
+    try:
+        import httptools  # noqa: F401
+        return "httptools"
+    except ImportError:
+        return "h11"
+
+
+def prepare_environment(plan: PoolPlan):
+    """Settings the workers read at import time - must be set before the app is imported"""
+    os.environ["DB_POOL_SIZE"] = str(plan.pool_size)
+    os.environ["DB_MAX_OVERFLOW"] = str(plan.max_overflow)
+    os.environ["DB_SYNC_POOL_SIZE"] = str(plan.sync_pool_size)
+    os.environ["DB_SYNC_MAX_OVERFLOW"] = str(plan.sync_max_overflow)
+    # bcrypt threads: share the CPUs between the workers instead of each taking all of them
+    os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, default_workers() // plan.workers)))
+    # /metrics merges the workers' snapshots from a shared directory, emptied on every start
+    metrics_dir = os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "capsule-metrics"))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def run_gunicorn(plan: PoolPlan, host: str, port: int) -> bool:
+    """Run under gunicorn with a preloaded app - False when gunicorn isn't installed"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        return False
+    try:
+        from uvicorn_worker import UvicornWorker
+    except ImportError:
+        from uvicorn.workers import UvicornWorker
+
+    class Worker(UvicornWorker):
+        CONFIG_KWARGS = {
+            **UvicornWorker.CONFIG_KWARGS,
+            "loop": pick_loop(),
+            "http": pick_http(),
+            "timeout_keep_alive": KEEPALIVE_TIMEOUT,
+        }
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{host}:{port}",
+                "workers": plan.workers,
+                "worker_class": Worker,
+                "preload_app": True,
+                "max_requests": WORKER_MAX_REQUESTS,
+                "max_requests_jitter": WORKER_MAX_REQUESTS_JITTER,
+                "timeout": WORKER_TIMEOUT,
+                "graceful_timeout": WORKER_GRACEFUL_TIMEOUT,
+                "keepalive": KEEPALIVE_TIMEOUT,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from backend.main import app
+            return app
+
+    Application().run()
+    return True
+
+
+def run_uvicorn(plan: PoolPlan, host: str, port: int):
+    import uvicorn
+
+    uvicorn.run(
+        APP,
+        host=host,
+        port=port,
+        workers=plan.workers,
+        loop=pick_loop(),
+        http=pick_http(),
+        limit_max_requests=WORKER_MAX_REQUESTS or None,
+        limit_max_requests_jitter=WORKER_MAX_REQUESTS_JITTER,
+        timeout_graceful_shutdown=WORKER_GRACEFUL_TIMEOUT,
+        timeout_keep_alive=KEEPALIVE_TIMEOUT,
+        proxy_headers=True,
+    )
+
+
+def serve(workers: Optional[int] = None, host: Optional[str] = None, port: Optional[int] = None):
+    workers = workers or int(os.getenv("SERVER_WORKERS", SERVER_WORKERS)) or default_workers()
+    host = host or os.getenv("SERVER_HOST", SERVER_HOST)
+    port = port or int(os.getenv("SERVER_PORT", SERVER_PORT))
+    budget = int(os.getenv("DB_CONNECTION_BUDGET", DB_CONNECTION_BUDGET))
+
+    plan = plan_pools(budget, workers)
+    prepare_environment(plan)
+
+    print(f"\n🚀 Starting {plan.workers} workers on {host}:{port} ({pick_loop()} / {pick_http()})")
+    print(f"   DB pool per worker: {plan.pool_size} + {plan.max_overflow} overflow (async), "
+          f"{plan.sync_pool_size} (sync) - at most {plan.total} of {budget} connections")
+
+    if not run_gunicorn(plan, host, port):
+        print("   gunicorn is not installed - using uvicorn's process manager (no preload)")
+        run_uvicorn(plan, host, port)
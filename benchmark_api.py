@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the API in-process through an ASGI transport")
+    parser.add_argument("--database-url", help="Database to seed and run against (default: a throwaway SQLite file)")
+    parser.add_argument("--users", type=int, default=1000, help="Citizens to seed before the run")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per read/write scenario")
+    parser.add_argument("--auth-requests", type=int, default=20, help="Requests per register/login scenario (bcrypt bound)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once")
+    parser.add_argument("--output", default="bench_output.json", help="Where to save the results as JSON")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed p95/throughput regression (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+
+# The database must be chosen before the backend is imported
+os.environ["DATABASE_URL"] = ARGS.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+os.environ.setdefault("DB_POOL_SIZE", str(ARGS.concurrency))
+# Every login comes from the same client - measure bcrypt, not the login throttle
+os.environ.setdefault("LOGIN_RATE_PER_IP", "0")
+os.environ.setdefault("LOGIN_RATE_PER_ACCOUNT", "0")
+
+import httpx
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from backend import crud, models, schemas
+from backend.database import async_engine, engine
+from backend.main import app
+from backend.query_counter import count_queries
+
+PASSWORD = "benchmark123"
+ADMIN_EMAIL = "bench-admin@example.com"
+
+
+def seed_database(count: int):
+    """Create the schema, an admin with every permission and `count` citizens with items"""
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    with Session(engine) as db:
+        admin_role = crud.create_role(db, schemas.RoleCreate(name="admin", description="System administrator"))
+        for name in ("read_public", "edit_profile", "manage_users", "admin_access"):
+            permission = crud.create_permission(db, schemas.PermissionCreate(name=name))
+            crud.assign_permission_to_role(db, admin_role.id, permission.id)
+        citizen_role = crud.create_role(db, crud.CITIZEN_ROLE)
+
+        hashed_password = crud.get_password_hash(PASSWORD)
+        admin = schemas.UserCreate(
+            email=ADMIN_EMAIL, password=PASSWORD, first_name="Bench", last_name="Admin", national_id="000000001"
+        )
+        db.add(crud.build_user(admin, admin_role.id, hashed_password))
+
+        rows = [
+            {
+                "email": f"citizen{i}@example.com",
+                "national_id": f"{100000000 + i}",
+                "first_name": "Israeli",
+                "last_name": f"Citizen {i}",
+                "hashed_password": hashed_password,
+                "city": "Tel Aviv",
+                "is_active": True,
+                "capsule_status": "not_ready",
+                "role_id": citizen_role.id,
+            }
+            for i in range(count)
+        ]
+        if rows:
+            db.execute(insert(models.User), rows)
+        db.flush()
+        user_ids = [user_id for (user_id,) in db.query(models.User.id).limit(count)]
+        db.execute(insert(models.Item), [
+            {"name": f"Item {user_id}", "owner_id": user_id, "is_active": True} for user_id in user_ids
+        ])
+        db.commit()
+        return user_ids
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(client, name: str, total: int, concurrency: int, make_request):
+    """Send `total` requests, `concurrency` at a time, and summarize latency / throughput / queries"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    with count_queries(async_engine) as counter:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0,
+        "queries_per_request": round(counter.count / total, 2) if total else 0.0,
+    }
+    print(f"  {name:<14} p50 {result['p50_ms']:>8.2f}ms  p95 {result['p95_ms']:>8.2f}ms  "
+          f"p99 {result['p99_ms']:>8.2f}ms  {result['throughput_rps']:>8.1f} req/s  "
+          f"{result['queries_per_request']:>5.1f} queries/req  {errors} errors")
+    return result
+
+
+async def run_benchmarks(user_ids):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        response = await client.post("/api/auth/login", data={"username": ADMIN_EMAIL, "password": PASSWORD})
+        response.raise_for_status()
+        admin_headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        run_id = int(time.time())
+
+        async def register(c, i):
+            return await c.post("/api/auth/register", json={
+                "email": f"bench-{run_id}-{i}@example.com",
+                "password": PASSWORD,
+                "first_name": "Bench",
+                "last_name": f"User {i}",
+                "national_id": f"{900000000 + i}",
+            })
+
+        async def login(c, i):
+            email = f"citizen{i % len(user_ids)}@example.com" if user_ids else ADMIN_EMAIL
+            return await c.post("/api/auth/login", data={"username": email, "password": PASSWORD})
+
+        async def list_users(c, i):
+            return await c.get("/api/users/", params={"limit": 100})
+
+        async def list_users_sparse(c, i):
+            return await c.get("/api/users/", params={"limit": 100, "fields": "id,first_name,last_name,city"})
+
+        async def user_detail(c, i):
+            return await c.get(f"/api/users/{user_ids[i % len(user_ids)]}")
+
+        async def create_item(c, i):
+            return await c.post(f"/api/users/{user_ids[i % len(user_ids)]}/items/", json={"name": f"Bench item {i}"})
+
+        # Type-ahead: growing prefixes of a name, then name + address
+        search_queries = ["is", "isr", "citizen 1", "citizen 12", "israeli tel", "tel aviv citizen 4"]
+
+        async def search_users(c, i):
+            return await c.get("/api/users/search", params={"q": search_queries[i % len(search_queries)]},
+                               headers=admin_headers)
+
+        scenarios = [
+            ("register", ARGS.auth_requests, register),
+            ("login", ARGS.auth_requests, login),
+            ("list_users", ARGS.requests, list_users),
+            ("list_sparse", ARGS.requests, list_users_sparse),
+            ("user_detail", ARGS.requests, user_detail),
+            ("create_item", ARGS.requests, create_item),
+            ("search", ARGS.requests, search_users),
+        ]
+        results = {}
+        for name, total, make_request in scenarios:
+            results[name] = await run_scenario(client, name, total, ARGS.concurrency, make_request)
+        return results
+
+
+def compare_results(current: dict, baseline: dict, threshold: float) -> list:
+    """Scenarios that got slower (p95), lost throughput or run more queries than the baseline"""
+    regressions = []
+    for name, result in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        if before["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+        if before["throughput_rps"] and result["throughput_rps"] < before["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {before['throughput_rps']} -> {result['throughput_rps']} req/s")
+        if result["queries_per_request"] > before["queries_per_request"]:
+            regressions.append(
+                f"{name}: queries/request {before['queries_per_request']} -> {result['queries_per_request']}"
+            )
+    return regressions
+
+
+def main():
+    print("\n⏱️ API benchmark (in-process ASGI)")
+    print("=" * 50)
+    print(f"Database: {engine.url.render_as_string(hide_password=True)}")
+
+    print(f"\n🌱 Seeding {ARGS.users} citizens...")
+    user_ids = seed_database(ARGS.users)
+
+    print(f"\n🚀 Running scenarios (concurrency {ARGS.concurrency})...")
+    scenarios = asyncio.run(run_benchmarks(user_ids))
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "database": engine.dialect.name,
+        "settings": {
+            "users": ARGS.users,
+            "requests": ARGS.requests,
+            "auth_requests": ARGS.auth_requests,
+            "concurrency": ARGS.concurrency,
+        },
+        "scenarios": scenarios,
+    }
+    with open(ARGS.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Results saved to {ARGS.output}")
+
+    if ARGS.compare:
+        with open(ARGS.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, ARGS.threshold)
+        if regressions:
+            print(f"\n❌ Regressions against {ARGS.compare}:")
+            for regression in regressions:
+                print(f"   - {regression}")
+            sys.exit(1)
+        print(f"\n✅ No regressions against {ARGS.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import os
+import re
+
+from backend import passwords
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.py")
+
+
+def write_cost(cost: int):
+    """Replace the PASSWORD_HASH_COST value in config.py, keeping its comment"""
+    with open(CONFIG_FILE, encoding="utf-8") as f:
+        source = f.read()
+    source, replaced = re.subn(r"^PASSWORD_HASH_COST = \d+", f"PASSWORD_HASH_COST = {cost}", source, flags=re.M)
+    if not replaced:
+        raise SystemExit("❌ PASSWORD_HASH_COST not found in config.py")
+    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+        f.write(source)
+
+
+def calibrate_password_hash():
+    parser = argparse.ArgumentParser(description="Pick the password hashing cost for this hardware")
+    parser.add_argument("--target-ms", type=float, default=passwords.PASSWORD_HASH_TARGET_MS,
+                        help="CPU time one hash may take")
+    parser.add_argument("--scheme", default=passwords.PASSWORD_HASH_SCHEME, choices=passwords.SCHEMES)
+    parser.add_argument("--write", action="store_true", help="Save the cost as PASSWORD_HASH_COST in config.py")
+    args = parser.parse_args()
+
+    print(f"\n⏱️ Calibrating {args.scheme} for {args.target_ms:.0f}ms per hash")
+    print("=" * 50)
+
+    policy = passwords.calibrate(target_ms=args.target_ms, scheme=args.scheme)
+    passwords.configure(policy)
+    seconds = passwords.time_hash(passwords.pwd_context)
+    print(f"  cost {policy.cost}: {seconds * 1000:.0f}ms per hash (currently {passwords.PASSWORD_HASH_COST})")
+
+    if args.write:
+        write_cost(policy.cost)
+        print("✅ Saved to config.py - restart the server to use it")
+    else:
+        print("   Run with --write to save it to config.py")
+    # Hashes below the new cost are replaced on their users' next login
+    print("   /api/admin/passwords shows how many stored hashes are below it")
+
+
+if __name__ == "__main__":
+    calibrate_password_hash()
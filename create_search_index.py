@@ -0,0 +1,24 @@
+from config import set_env_vars
+from backend import search
+from backend.database import engine
+
+def create_search_index():
+    """Add the citizen search index (pg_trgm / FTS5) to a database created before it"""
+
+    print("\n🔄 Creating the citizen search index...")
+
+    try:
+        with engine.begin() as connection:
+            search.create_index(connection)
+        print(f"✅ Search index ready ({engine.dialect.name})")
+
+    except Exception as e:
+        print(f"❌ Error creating the search index: {str(e)}")
+        if engine.dialect.name == "postgresql":
+            print("   The pg_trgm extension must be available (CREATE EXTENSION needs the right privileges).")
+
+if __name__ == "__main__":
+    # Set environment variables
+    set_env_vars()
+
+    create_search_index()
@@ -0,0 +1,54 @@
+import argparse
+import sys
+import time
+
+from config import set_env_vars
+
+
+def main():
+    """Bulk import citizens from a CSV or NDJSON file of UserCreate records"""
+    parser = argparse.ArgumentParser(description="Bulk import citizens (CSV or NDJSON)")
+    parser.add_argument("path", help="CSV or NDJSON file with UserCreate records")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="Input format (default: from the file extension)")
+    parser.add_argument("--rejects", help="Where to write rejected rows (default: <path>.rejects.ndjson)")
+    parser.add_argument("--chunk-size", type=int, help="Records validated and inserted per chunk")
+    parser.add_argument("--workers", type=int, help="Password hashing processes (default: CPU count)")
+    args = parser.parse_args()
+
+    # Set environment variables before the backend reads them
+    set_env_vars()
+
+    from backend import bulk_import
+    from backend.database import SessionLocal
+
+    fmt = args.format or bulk_import.detect_format(args.path)
+    rejects_path = args.rejects or f"{args.path}.rejects.ndjson"
+    options = {}
+    if args.chunk_size:
+        options["chunk_size"] = args.chunk_size
+    if args.workers:
+        options["workers"] = args.workers
+
+    print(f"\n📥 Importing citizens from {args.path} ({fmt})...")
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        with open(args.path, encoding="utf-8-sig", newline="") as stream, \
+                open(rejects_path, "w", encoding="utf-8") as rejects_file:
+            result = bulk_import.import_users(db, stream, fmt, rejects_file=rejects_file, **options)
+    except Exception as e:
+        print(f"❌ Import failed: {str(e)}")
+        sys.exit(1)
+    finally:
+        db.close()
+        bulk_import.shutdown_executor()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ Imported {result.inserted} of {result.total} records in {elapsed:.1f}s "
+          f"({result.total / elapsed if elapsed else 0:.0f} records/s, {result.chunks} chunks)")
+    if result.rejected:
+        print(f"⚠️ {result.rejected} rejected rows written to {rejects_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+from config import set_env_vars
+from backend import models, rollups
+from backend.database import Base, engine
+
+def rebuild_capsule_rollups():
+    """Recompute the capsule status counts (capsule_status_counts) from the users table"""
+
+    print("\n🔄 Rebuilding capsule status counts...")
+
+    try:
+        # The table is derived data - one from before the shard column is recreated
+        table = models.CapsuleStatusCount.__table__
+        inspector = inspect(engine)
+        if inspector.has_table(table.name) and "shard" not in {c["name"] for c in inspector.get_columns(table.name)}:
+            table.drop(bind=engine)
+        # Creates capsule_status_counts on databases from before the rollup
+        Base.metadata.create_all(bind=engine, tables=[models.CapsuleStatusCount.__table__])
+
+        with Session(engine) as db:
+            rows = rollups.rebuild(db)
+        print(f"✅ Rebuilt {rows} rows (city, neighborhood, capsule status)")
+
+    except Exception as e:
+        print(f"❌ Error rebuilding capsule status counts: {str(e)}")
+
+if __name__ == "__main__":
+    # Set environment variables
+    set_env_vars()
+
+    rebuild_capsule_rollups()
@@ -1,8 +1,15 @@
+import argparse
 import uvicorn
 from config import set_env_vars
 import sys
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start the FastAPI backend")
+    parser.add_argument("--production", action="store_true",
+                        help="Multiple workers sized from the CPU count and DB_CONNECTION_BUDGET, no reload")
+    parser.add_argument("--workers", type=int, help="Worker count for --production (default: one per CPU)")
+    args = parser.parse_args()
+
     # Set environment variables from config.py
     set_env_vars()
     
@@ -10,9 +17,13 @@ if __name__ == "__main__":
     print("💡 To verify your PostgreSQL connection first, run: python verify_postgres.py")
     
     try:
-        # Run the FastAPI application
-        uvicorn.run("backend.main:app", host="127.0.0.1", port=8000, reload=True)
+        if args.production:
+            from backend.serve import serve
+            serve(workers=args.workers)
+        else:
+            # Run the FastAPI application
+            uvicorn.run("backend.main:app", host="127.0.0.1", port=8000, reload=True)
     except Exception as e:
         print(f"\n❌ Error starting server: {str(e)}")
         print("Make sure PostgreSQL is installed and running with the correct credentials")
-        sys.exit(1) 
\ No newline at end of file
+        sys.exit(1) 
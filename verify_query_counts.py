@@ -0,0 +1,155 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+# Run against a throwaway SQLite database with relationships in lazy="raise" mode
+DB_FILE = os.path.join(tempfile.mkdtemp(), "query_counts.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_FILE}"
+os.environ["DB_STRICT_LOADING"] = "1"
+# Count the queries of the endpoints themselves, not response cache hits
+os.environ["RESPONSE_CACHE_TTLS"] = "users=0,items=0"
+
+import httpx
+from sqlalchemy.orm import Session
+
+from backend import crud, database, models, rollups, schemas
+from backend.passwords import hash_password_sync
+from backend.database import async_engine, engine
+from backend.main import app
+from backend.query_counter import count_queries
+
+PASSWORD = "citizen123"
+
+
+def seed_users(count: int, items_per_user: int = 2):
+    """Add `count` citizens (with items) to the database"""
+    with Session(engine) as db:
+        role = db.query(models.Role).filter(models.Role.name == "citizen").first()
+        if role is None:
+            role = models.Role(name="citizen", description="Regular citizen user")
+            db.add(role)
+            db.flush()
+        start = db.query(models.User).count()
+        hashed_password = hash_password_sync(PASSWORD)
+        for i in range(start, start + count):
+            user = models.User(
+                email=f"citizen{i}@example.com",
+                national_id=f"{i:09d}",
+                first_name="Israeli",
+                last_name=f"Citizen {i}",
+                hashed_password=hashed_password,
+                role_id=role.id,
+            )
+            user.items = [models.Item(name=f"Item {j}") for j in range(items_per_user)]
+            db.add(user)
+        db.commit()
+
+
+async def measure(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> int:
+    with count_queries(async_engine) as counter:
+        response = await client.request(method, url, **kwargs)
+    response.raise_for_status()
+    return counter.count
+
+
+async def verify_registration(client: httpx.AsyncClient) -> bool:
+    """Registration is an INSERT plus the capsule status rollup upsert, and a duplicate is
+    rejected by that same INSERT"""
+    user = {
+        "email": "new.citizen@example.com",
+        "password": PASSWORD,
+        "first_name": "New",
+        "last_name": "Citizen",
+        "national_id": "900000001",
+    }
+    duplicates = [
+        dict(user, national_id="900000002"),
+        dict(user, email="other.citizen@example.com"),
+    ]
+    # The first registration loads the citizen role into the role cache
+    await measure(client, "POST", "/api/auth/register", json=dict(user, email="first@example.com", national_id="900000000"))
+    counts = [await measure(client, "POST", "/api/auth/register", json=user)]
+    rejected = True
+    for duplicate in duplicates:
+        with count_queries(async_engine) as counter:
+            response = await client.post("/api/auth/register", json=duplicate)
+        counts.append(counter.count)
+        rejected = rejected and response.status_code == 400
+
+    if counts == [2, 1, 1] and rejected:
+        print("✅ POST /api/auth/register: 2 queries, duplicates rejected with 400 after 1")
+        return True
+    print(f"❌ POST /api/auth/register: {counts} queries (new, duplicate email, duplicate national ID), "
+          f"duplicates rejected: {rejected}")
+    return False
+
+
+async def verify_concurrent_moves() -> bool:
+    """Two profile updates moving the same citizen at once must leave the capsule status
+    rollup equal to a rebuild from users - each reads the old key under the row lock"""
+    with Session(engine) as db:
+        rollups.rebuild(db)
+        user_id = db.query(models.User.id).order_by(models.User.id).first()[0]
+
+    async def move(changes: schemas.UserUpdate):
+        async with database.AsyncSessionLocal() as db:
+            await crud.update_user_async(db, user_id, changes)
+
+    await asyncio.gather(
+        move(schemas.UserUpdate(city="Haifa", capsule_status="pending")),
+        move(schemas.UserUpdate(city="Eilat", capsule_status="approved")),
+    )
+    async with database.AsyncSessionLocal() as db:
+        maintained = await rollups.read_counts(db)
+    with Session(engine) as db:
+        rollups.rebuild(db)
+    async with database.AsyncSessionLocal() as db:
+        rebuilt = await rollups.read_counts(db)
+
+    if maintained == rebuilt:
+        print("✅ Concurrent profile updates: capsule status counts match a rebuild")
+        return True
+    print(f"❌ Concurrent profile updates: capsule status counts {maintained['by_status']}, "
+          f"rebuilt {rebuilt['by_status']}")
+    return False
+
+
+async def verify_query_counts():
+    """Check that each endpoint runs the same number of queries for 10 and 100 rows"""
+
+    print("\n🔍 Verifying query counts per endpoint")
+    print("=" * 50)
+
+    checks = [
+        ("GET", "/api/users/?limit=1000", {}),
+        ("GET", "/api/users/1", {}),
+        ("GET", "/api/items/?limit=1000", {}),
+        ("POST", "/api/auth/login", {"data": {"username": "citizen0@example.com", "password": PASSWORD}}),
+    ]
+
+    # ASGITransport doesn't send lifespan events - run startup (schema, permission registry) ourselves
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        seed_users(10)
+        small = [await measure(client, method, url, **kwargs) for method, url, kwargs in checks]
+        seed_users(90)
+        large = [await measure(client, method, url, **kwargs) for method, url, kwargs in checks]
+        registration_ok = await verify_registration(client)
+        moves_ok = await verify_concurrent_moves()
+
+    failed = False
+    for (method, url, _), small_count, large_count in zip(checks, small, large):
+        if small_count == large_count:
+            print(f"✅ {method} {url}: {small_count} queries for 10 and 100 users")
+        else:
+            failed = True
+            print(f"❌ {method} {url}: {small_count} queries for 10 users, {large_count} for 100")
+
+    return registration_ok and moves_ok and not failed
+
+
+if __name__ == "__main__":
+    ok = asyncio.run(verify_query_counts())
+    sys.exit(0 if ok else 1)